@@ -10,6 +10,7 @@ import texttestlib.default.rundependent
 import texttestlib.default.comparetest
 import texttestlib.default.batch
 import texttestlib.default.performance
+import texttestlib.default.grepindex
 from .. import plugins
 from copy import copy
 from string import Template
@@ -117,6 +118,8 @@ class Config:
                                 possibleValues=["", "site", "personal", "all"])
                 self.addDefaultSwitch(group, "keeptmp", "Keep temporary write-directories")
                 group.addSwitch("ignorefilters", "Ignore all run-dependent text filtering")
+                group.addSwitch("clearcache", "Clear cache of filtered approved files")
+                group.addOption("j", "Tests to run in parallel locally")
             elif group.name.startswith("Self-diagnostics"):
                 self.addDefaultSwitch(group, "x", "Enable self-diagnostics")
                 defaultDiagDir = plugins.getPersonalDir("log")
@@ -471,8 +474,12 @@ class Config:
             not self.isActionReplay() and "coll" not in self.optionMap and not self.optionMap.runScript()
 
     def getThreadActionClasses(self):
-        from .actionrunner import ActionRunner
-        return [ActionRunner]
+        from .actionrunner import ActionRunner, ParallelActionRunner
+        # Scripts do most of their work in their set up, which only runs once anyway
+        if self.optionIntValue("j") > 1 and not self.optionMap.runScript():
+            return [ParallelActionRunner]
+        else:
+            return [ActionRunner]
 
     def getTextDisplayResponderClass(self):
         return console.TextDisplayResponder
@@ -772,7 +779,8 @@ class Config:
                 filters.append(performance.TimeFilter(timeLimit))
         if "grep" in optionMap:
             grepFile = optionMap.get("grepfile", app.getConfigValue("log_file"))
-            filters.append(GrepFilter(optionMap["grep"], grepFile, **kw))
+            filters.append(GrepFilter(optionMap["grep"], grepFile, indexFile=app.getConfigValue("grep_index_file"),
+                                      indexMaxFileSize=plugins.parseBytes(app.getConfigValue("grep_index_max_file_size")), **kw))
         return filters
 
     def batchMode(self):
@@ -984,6 +992,10 @@ class Config:
             else:
                 raise
 
+    def finishTestTreeRead(self, app):
+        # Whatever -grep indexed while selecting the tests is kept for next time, even if nothing matched
+        texttestlib.default.grepindex.GrepIndex.saveAll()
+
     def checkSanity(self, suite):
         if not self.ignoreCheckout():
             self.checkCheckoutExists(suite.app)
@@ -1004,6 +1016,8 @@ class Config:
         if self.isReconnecting():
             self.reconnectConfig.checkSanity(suite.app)
         # side effects really from here on :(
+        if "clearcache" in self.optionMap:
+            rundependent.FilterCache.clear(suite.app)
         if self.readsTestStateFiles():
             # Reading stuff from stored pickle files, need to set up categories independently
             self.setUpPerformanceCategories(suite.app)
@@ -1236,6 +1250,8 @@ class Config:
                              "Password for SMTP authentication when sending mail in batch mode")
         app.setConfigDefault("batch_result_repository", {"default": ""},
                              "Directory to store historical batch results under")
+        app.setConfigDefault("batch_result_database", {"default": "false"},
+                             "Store historical batch results in an SQLite database in the repository, rather than as files")
         app.setConfigDefault("file_to_url", {}, "Mapping of file locations to URLS, for linking to HTML reports")
         app.setConfigDefault("historical_report_location", {"default": ""},
                              "Directory to create reports on historical batch data under")
@@ -1402,6 +1418,16 @@ class Config:
 
     def setComparisonDefaults(self, app, homeOS, namingScheme):
         app.setConfigDefault("log_file", self.getStdoutName(namingScheme), "Result file to search, by default")
+        app.setConfigDefault("grep_index_file", "",
+                             "File to keep an index of the result files in, to speed up searching them with -grep")
+        app.setConfigDefault("grep_index_max_file_size", "10M",
+                             "Result files bigger than this are not put in the grep_index_file, but searched every time")
+        app.setConfigDefault("file_comparison_processes", 0,
+                             "Number of processes to filter and compare a test's result files in (0 means do it all in the TextTest process)")
+        app.setConfigDefault("file_comparison_parallel_size", "1M",
+                             "Result files smaller than this are always filtered and compared in the TextTest process")
+        app.setConfigDefault("large_file_size", "100M",
+                             "Result files at least this big are filtered and previewed without reading them into memory")
         app.setConfigDefault("failure_severity", self.defaultSeverities(),
                              "Mapping of result files to how serious diffs in them are")
         app.setConfigDefault("failure_display_priority", self.defaultDisplayPriorities(),
@@ -1430,6 +1456,10 @@ class Config:
 
         app.setConfigDefault("unordered_text", {"default": []},
                              "Mapping of patterns to extract and sort from result files", trackFiles=True)
+        app.setConfigDefault("keep_intermediate_filter_files", "false",
+                             "Write the result of each filtering stage to its own file, for debugging filters")
+        app.setConfigDefault("filter_cache_location", "",
+                             "Directory in which to keep filtered approved files between runs. Empty means no caching")
         app.setConfigDefault("file_split_pattern", {}, "Pattern to use for splitting result files")
         app.setConfigDefault("create_catalogues", "false", "Do we create a listing of files created/removed by tests")
         app.setConfigAlias("collect_file_changes", "create_catalogues")
@@ -1494,6 +1524,9 @@ class Config:
     def setExternalToolDefaults(self, app, homeOS):
         app.setConfigDefault("text_diff_program", "diff",
                              "External program to use for textual comparison of files")
+        app.setConfigDefault("builtin_text_diff_previews", "false",
+                             "Create previews for the text_diff_program 'diff' or 'diff -u' without starting it. " +
+                             "A change that could be shown in more than one place may be placed differently from GNU diff")
         app.setConfigDefault("lines_of_text_difference", 30,
                              "How many lines to present in textual previews of file diffs")
         app.setConfigDefault("max_width_text_difference", 500,
@@ -1782,10 +1815,19 @@ class TestRelPathFilter(plugins.TextFilter):
 
 
 class GrepFilter(plugins.TextFilter):
-    def __init__(self, filterText, fileStem, useTmpFiles=False):
+    def __init__(self, filterText, fileStem, useTmpFiles=False, indexFile="", indexMaxFileSize=None):
         plugins.TextFilter.__init__(self, filterText)
         self.fileStem = fileStem
         self.useTmpFiles = useTmpFiles
+        self.index = None
+        self.trigramSets = []
+        if indexFile and not useTmpFiles and fileStem != "free_text" and self.canUseIndex():
+            self.index = texttestlib.default.grepindex.GrepIndex.forFile(os.path.expanduser(indexFile), indexMaxFileSize)
+            self.trigramSets = [texttestlib.default.grepindex.getTrigrams(text) for text in self.texts]
+
+    def canUseIndex(self):
+        # Patterns and very short texts can't be looked up in the index
+        return all((not trigger.regex and len(trigger.text) >= 3 for trigger in self.textTriggers))
 
     def acceptsTestCase(self, test):
         if self.fileStem == "free_text":
@@ -1818,7 +1860,15 @@ class GrepFilter(plugins.TextFilter):
                 return self.findAllStdFiles(test)
         return logFiles
 
+    def refine(self, tests):
+        # Called when selecting in the GUI, once everything has been searched. Keep what we indexed for next time
+        if self.index:
+            self.index.save()
+        return tests
+
     def matches(self, logFile):
+        if self.index and not self.index.mightContain(logFile, self.trigramSets):
+            return False
         for line in open(logFile, errors="ignore"):
             if self.stringContainsText(line):
                 return True
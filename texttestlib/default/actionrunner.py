@@ -5,7 +5,7 @@ import types
 from texttestlib import plugins
 from queue import Queue, Empty
 from collections import OrderedDict
-from threading import Lock
+from threading import Lock, RLock, Thread
 
 plugins.addCategory("cancelled", "cancelled", "were cancelled before starting")
 
@@ -180,6 +180,120 @@ class ActionRunner(BaseActionRunner):
             appRunner.cleanActions()
 
 
+class ParallelActionRunner(ActionRunner):
+    """ Runs several tests at once in the same process. Each worker thread has its own copy of the
+    action sequence, as actions are free to keep state about the test they are running """
+    def __init__(self, optionMap, *args):
+        ActionRunner.__init__(self, optionMap, *args)
+        self.workerCount = int(optionMap.get("j"))
+        self.workers = []
+        self.suiteSetUpRegistry = SuiteSetUpRegistry()
+
+    def addSuite(self, suite):
+        plugins.log.info("Using " + suite.app.description(includeCheckout=True))
+        self.appRunners[suite.app] = ApplicationRunner(suite, self.diag, self.suiteSetUpRegistry)
+
+    def runAllTests(self):
+        # Observers aren't written to be called from several threads at once
+        plugins.Observable.directNotificationLock = RLock()
+        self.workers = [TestWorker(self, self.appRunners)]
+        for _ in range(self.workerCount - 1):
+            appRunners = OrderedDict()
+            for app, appRunner in self.appRunners.items():
+                appRunners[app] = ApplicationRunner(appRunner.testSuite, self.diag, self.suiteSetUpRegistry, isCopy=True)
+            self.workers.append(TestWorker(self, appRunners))
+        threads = []
+        for index, worker in enumerate(self.workers):
+            thread = Thread(target=worker.run, name="TestWorker-" + str(index + 1))
+            threads.append(thread)
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.cleanup()
+        self.diag.info("Terminating")
+
+    def getTestForRun(self, block=True):
+        # Put the terminator back, so all workers see it
+        return self.getItemFromQueue(self.testQueue, block=block, replaceTerminators=True)
+
+    def notifyRerun(self, test):
+        for worker in self.workers:
+            if worker.currentTestRunner and worker.currentTestRunner.test is test:
+                self.diag.info("Got rerun notification for " + repr(test) + ", resetting actions")
+                worker.currentTestRunner.resetActionSequence()
+
+    def killTests(self):
+        for worker in self.workers:
+            if worker.currentTestRunner:
+                worker.currentTestRunner.kill(self.killSignal)
+
+    def killOrCancel(self, test):
+        for worker in self.workers:
+            if worker.currentTestRunner and worker.currentTestRunner.test is test:
+                worker.currentTestRunner.kill()
+                return
+        self.cancel(test)
+
+    def getAllActionClasses(self):
+        classes = set()
+        for worker in self.workers:
+            for appRunner in list(worker.appRunners.values()):
+                for action in appRunner.actionSequence:
+                    classes.add(action.__class__)
+        return classes
+
+    def cleanup(self):
+        for actionClass in self.getAllActionClasses():
+            actionClass.finalise()
+        for worker in self.workers:
+            for appRunner in list(worker.appRunners.values()):
+                appRunner.cleanActions()
+
+
+class TestWorker:
+    def __init__(self, actionRunner, appRunners):
+        self.actionRunner = actionRunner
+        self.appRunners = appRunners
+        self.currentTestRunner = None
+        self.previousTestRunner = None
+
+    def run(self):
+        self.actionRunner.runQueue(self.actionRunner.getTestForRun, self.runTest, "running")
+
+    def runTest(self, test):
+        appRunner = self.appRunners.get(test.app)
+        if appRunner:
+            runner = self.actionRunner
+            runner.lock.acquire()
+            self.currentTestRunner = TestRunner(test, appRunner, runner.diag, runner.exited, runner.killSignal)
+            runner.lock.release()
+
+            self.currentTestRunner.performActions(self.previousTestRunner)
+            self.previousTestRunner = self.currentTestRunner
+
+            runner.lock.acquire()
+            self.currentTestRunner = None
+            runner.notifyComplete(test)
+            runner.lock.release()
+
+
+class SuiteSetUpRegistry:
+    # Makes sure each suite is fully set up only once per action, by whichever worker gets there first.
+    # The other workers' copies of the action are set up afterwards, without the side effects
+    def __init__(self):
+        self.lock = Lock()
+        self.setUp = set()
+
+    def setUpSuite(self, appRunner, action, suite):
+        key = suite, appRunner.actionSequence.index(action)
+        with self.lock:
+            if key not in self.setUp:
+                action.setUpSuite(suite)
+                self.setUp.add(key)
+                return
+        action.setUpSuiteInCopy(suite)
+
+
 class ActionsCompleteAction(plugins.Action):
     def __call__(self, test):
         test.actionsCompleted()
@@ -189,16 +303,21 @@ class ActionsCompleteAction(plugins.Action):
         if suite.state.hasStarted():
             suite.actionsCompleted()
 
+    def setUpSuiteInCopy(self, suite):
+        pass
+
     def callDuringAbandon(self, *args):
         return True
 
 
 class ApplicationRunner:
-    def __init__(self, testSuite, diag):
+    def __init__(self, testSuite, diag, suiteSetUpRegistry=None, isCopy=False):
         self.testSuite = testSuite
         self.suitesSetUp = {}
         self.suitesToSetUp = {}
         self.diag = diag
+        self.suiteSetUpRegistry = suiteSetUpRegistry
+        self.isCopy = isCopy
         self.actionSequence = self.getActionSequence()
         self.setUpApplications()
 
@@ -215,7 +334,10 @@ class ApplicationRunner:
     def setUpApplicationFor(self, action):
         self.diag.info("Performing " + str(action) + " set up on " + repr(self.testSuite.app))
         try:
-            action.setUpApplication(self.testSuite.app)
+            if self.isCopy:
+                action.setUpApplicationInCopy(self.testSuite.app)
+            else:
+                action.setUpApplication(self.testSuite.app)
         except Exception:
             sys.stderr.write("Exception thrown performing " + str(action) +
                              " set up on " + repr(self.testSuite.app) + " :\n")
@@ -237,7 +359,10 @@ class ApplicationRunner:
 
     def setUpSuite(self, action, suite):
         self.diag.info(str(action) + " set up " + repr(suite))
-        action.setUpSuite(suite)
+        if self.suiteSetUpRegistry is None:
+            action.setUpSuite(suite)
+        else:
+            self.suiteSetUpRegistry.setUpSuite(self, action, suite)
         if suite in self.suitesSetUp:
             self.suitesSetUp[suite].append(action)
         else:
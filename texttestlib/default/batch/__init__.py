@@ -10,6 +10,7 @@ import re
 import tarfile
 import stat
 from texttestlib.default.batch import testoverview
+from .resultdatabase import ResultDatabase, getNewPerformance
 from texttestlib import plugins
 from .summarypages import GenerateSummaryPage, GenerateGraphs  # only so they become package level entities
 from .ci import CIPlatform
@@ -523,6 +524,8 @@ class SaveState(plugins.Responder):
 
     def saveToRepository(self, test):
         testRepository = self.repositories[test.app]
+        if test.app.getBatchConfigValue("batch_result_database") == "true":
+            return self.saveToDatabase(test, testRepository)
         targetDir = os.path.join(testRepository, test.app.name, getVersionName(test.app, self.allApps),
                                  test.getRelPath())
         try:
@@ -544,6 +547,21 @@ class SaveState(plugins.Responder):
                 except EnvironmentError:
                     plugins.printWarning("Could not write file at " + targetFile)
 
+    def saveToDatabase(self, test, testRepository):
+        database = ResultDatabase.forRepository(testRepository, create=True)
+        stateData = None
+        # Succeeded tests are fully described by the columns, unless we have resource pages
+        if not test.state.hasSucceeded() or len(test.app.getBatchConfigValue("historical_report_resources")) > 0:
+            try:
+                with open(test.getStateFile(), "rb") as f:
+                    stateData = f.read()
+            except EnvironmentError:
+                plugins.printWarning("Could not read state file at " + test.getStateFile())
+                return
+        performance = getNewPerformance(test.state, test.getConfigValue("default_performance_stem"))
+        database.addResult(test.app.name, getVersionName(test.app, self.allApps), test.getRelPath(),
+                           self.runPostfix, test.state, stateData, performance)
+
     def addSuite(self, suite):
         testStateRepository = getBatchRepository(suite)
         self.diag.info("Test state repository is " + repr(testStateRepository))
@@ -618,6 +636,10 @@ class MigrateBatchRepository(plugins.Action):
                 if f.startswith("teststate_"):
                     path = os.path.join(root, f)
                     self.migrateFile(path)
+        database = ResultDatabase.forRepository(repository)
+        if database is not None:
+            count = database.removeSucceededStates()
+            plugins.log.info("Removed the stored state of " + str(count) + " succeeded results in " + database.path)
 
     def setUpSuite(self, suite):
         if suite.parent is None:
@@ -631,6 +653,52 @@ class MigrateBatchRepository(plugins.Action):
             self.migrate(repository)
 
 
+class ImportBatchRepository(plugins.Action):
+    """ Move the results in the teststate files and succeeded_runs files into the results database.
+    Use with batch_result_database set to "true", so that future runs are stored there too """
+    def __init__(self):
+        self.successFileName = "succeeded_runs"
+
+    def importFile(self, database, appName, version, testPath, path, perfStem):
+        fn = os.path.basename(path)
+        if fn == self.successFileName:
+            imported = True
+            with open(path) as f:
+                for line in f:
+                    parts = line.strip().split(" ", 1)
+                    if len(parts) == 2:
+                        imported &= database.addSuccess(appName, version, testPath, *parts)
+        else:
+            state = testoverview.GenerateWebPages.readState(path)
+            with open(path, "rb") as f:
+                stateData = f.read()
+            imported = database.addResult(appName, version, testPath, fn.replace("teststate_", ""),
+                                          state, stateData, getNewPerformance(state, perfStem))
+        # Don't leave them behind, the report would show them twice
+        if imported:
+            os.remove(path)
+
+    def importRepository(self, database, appDir, perfStem):
+        plugins.log.info("Importing repository at " + appDir + " into " + database.path)
+        appName = os.path.basename(appDir)
+        for version in sorted(os.listdir(appDir)):
+            versionDir = os.path.join(appDir, version)
+            for root, _, files in sorted(os.walk(versionDir)):
+                testPath = plugins.relpath(root, versionDir)
+                for f in sorted(files):
+                    if f.startswith("teststate_") or f == self.successFileName:
+                        self.importFile(database, appName, version, testPath, os.path.join(root, f), perfStem)
+
+    def setUpSuite(self, suite):
+        if suite.parent is None:
+            repository = getBatchRepository(suite)
+            appDir = os.path.join(repository, suite.app.name)
+            if not os.path.isdir(appDir):
+                raise plugins.TextTestError("Batch result repository " + appDir + " does not exist")
+            database = ResultDatabase.forRepository(repository, create=True)
+            self.importRepository(database, appDir, suite.getConfigValue("default_performance_stem"))
+
+
 class ArchiveScript(plugins.ScriptWithArgs):
     def __init__(self, argDict):
         self.descriptors = []
@@ -697,12 +765,15 @@ class ArchiveScript(plugins.ScriptWithArgs):
         if suite.parent is None:
             repository = self.getRepository(suite)
             self.repository = os.path.join(repository, suite.app.name)
-            if not os.path.isdir(self.repository):
+            if not self.repositoryExists():
                 raise plugins.TextTestError("Batch result repository " + self.repository + " does not exist")
             self.archiveFiles(suite)
             if os.name == "posix":
                 self.makeTarArchive(suite, repository)
 
+    def repositoryExists(self):
+        return os.path.isdir(self.repository)
+
     def archiveFile(self, fullPath, app, *args):
         targetPath = self.getTargetPath(fullPath, app.name)
         plugins.ensureDirExistsForFile(targetPath)
@@ -747,12 +818,39 @@ class ArchiveRepository(ArchiveScript):
         weekdayNames = sum(weekdayNameLists, [])
         return list(map(plugins.weekdays.index, weekdayNames))
 
+    def repositoryExists(self):
+        database, appName = ResultDatabase.forAppDirectory(self.repository)
+        return ArchiveScript.repositoryExists(self) or (database is not None and len(database.getVersions(appName)) > 0)
+
     def archiveFiles(self, suite):
         weekdays = self.getWeekDays(suite)
         runDir = os.path.join(os.path.dirname(self.repository), "run_names")
         if os.path.isdir(runDir):
             self.archiveFilesUnder(runDir, suite.app, weekdays, True)
-        self.archiveVersionDirsUnder(self.repository, suite.app, weekdays, False)
+        if os.path.isdir(self.repository):
+            self.archiveVersionDirsUnder(self.repository, suite.app, weekdays, False)
+        self.archiveDatabase(suite.app, weekdays)
+
+    def archiveDatabase(self, app, weekdays):
+        # Results in the database go to a database in the history directory, which is archived along with the files
+        database, appName = ResultDatabase.forAppDirectory(self.repository)
+        if database is None:
+            return
+        appVersions = set(app.versions)
+        historyDatabase = None
+        for version in sorted(database.getVersions(appName)):
+            if appVersions.issubset(set(version.split("."))):
+                runs = [run for run in database.getRuns(appName, version) if self.shouldArchiveGivenTag(run, weekdays)]
+                if runs:
+                    if historyDatabase is None:
+                        historyDir = os.path.join(os.path.dirname(self.repository), appName + "_history")
+                        historyDatabase = ResultDatabase.forRepository(historyDir, create=True)
+                    count = database.moveRuns(appName, version, runs, historyDatabase)
+                    plugins.log.info("Archived " + str(count) + " results " + ", ".join(self.descriptors) +
+                                     " for version " + version + " from " + database.path)
+        if historyDatabase is not None:
+            # Must be closed before it's archived
+            historyDatabase.close()
 
     def archiveVersionDirsUnder(self, repository, app, *args):
         appVersions = set(app.versions)
@@ -906,6 +1004,9 @@ class ArchiveExtractor:
 
 
 class WebPageResponder(plugins.Responder):
+    # Besides the historical_report_* entries, config that changes what the pages contain
+    reportConfigEntries = ["batch_include_comment_plugin", "file_to_url", "performance_variation_serious_%"]
+
     def __init__(self, optionMap, allApps):
         plugins.Responder.__init__(self)
         self.archiveExtractor = ArchiveExtractor(optionMap.get(
@@ -984,10 +1085,19 @@ class WebPageResponder(plugins.Responder):
                     if version != "default":
                         title += "." + version
                     self.makeAndGenerate({version: d}, self.getConfigValueMethod(app), pageDir, title, pageSubTitles,
-                                         version, extraVersions, self.getDescriptionInfo([app]))
+                                         version, extraVersions, self.getDescriptionInfo([app]),
+                                         self.getReportConfig([app]))
             else:
                 self.makeAndGenerate(relevantSubDirs, self.getConfigValueMethod(app), pageDir, pageTitle, pageSubTitles,
-                                     version, extraVersions, self.getDescriptionInfo([app]))
+                                     version, extraVersions, self.getDescriptionInfo([app]), self.getReportConfig([app]))
+
+    def getReportConfig(self, apps):
+        # So that pages are regenerated when the config they're generated from changes
+        reportConfig = []
+        for app in apps:
+            entries = [key for key in app.configDir if key.startswith("historical_report_")] + self.reportConfigEntries
+            reportConfig += [(app.name, entry, app.getConfigValue(entry)) for entry in entries]
+        return reportConfig
 
     def getConfigValueMethod(self, app):
         def getConfigValue(key, subKey=app.getBatchSession(), allSubKeys=False):
@@ -1059,12 +1169,16 @@ class WebPageResponder(plugins.Responder):
         return repositories
 
     def checkRepository(self, repository, app):
-        if not os.path.isdir(repository):
+        if not os.path.isdir(repository) and not self.getDatabaseVersions(repository):
             plugins.printWarning("Batch result repository " + repository +
                                  " does not exist - not creating pages for " + repr(app))
             return False
         return True
 
+    def getDatabaseVersions(self, repository):
+        database, appName = ResultDatabase.forAppDirectory(repository)
+        return database.getVersions(appName) if database is not None else []
+
     def getAppsToGenerate(self):
         return [suite.app for suite in self.suitesToGenerate]
 
@@ -1090,7 +1204,8 @@ class WebPageResponder(plugins.Responder):
         getConfigValue = plugins.ResponseAggregator([self.getConfigValueMethod(app) for app in allApps])
         pageSubTitles = self.makePageSubTitles(allApps)
         descriptionInfo = self.getDescriptionInfo(allApps)
-        return relevantSubDirs, getConfigValue, version, extraVersions, pageSubTitles, descriptionInfo
+        return relevantSubDirs, getConfigValue, version, extraVersions, pageSubTitles, descriptionInfo, \
+            self.getReportConfig(allApps)
 
     def getVersionTitle(self, app, version):
         title = app.fullName()
@@ -1099,12 +1214,12 @@ class WebPageResponder(plugins.Responder):
         return title
 
     def generateCommonPage(self, pageTitle, pageInfo):
-        relevantSubDirs, getConfigValue, version, extraVersions, pageSubTitles, descriptionInfo = self.transformToCommon(
-            pageInfo)
+        relevantSubDirs, getConfigValue, version, extraVersions, pageSubTitles, descriptionInfo, reportConfig = \
+            self.transformToCommon(pageInfo)
         pageDir = os.path.expanduser(getConfigValue("historical_report_location"))
         self.copyJavaScript(pageDir, pageDir, getConfigValue)
         self.makeAndGenerate(relevantSubDirs, getConfigValue, pageDir, pageTitle,
-                             pageSubTitles, version, extraVersions, descriptionInfo)
+                             pageSubTitles, version, extraVersions, descriptionInfo, reportConfig)
 
     def copyJavaScript(self, pageTopDir, pageDir, getConfigValue):
         jsDir = os.path.join(pageTopDir, "javascript")
@@ -1154,8 +1269,10 @@ class WebPageResponder(plugins.Responder):
     def findRelevantSubdirectories(self, repositories, app, extraVersions, versionTitleMethod=None):
         subdirs = OrderedDict()
         for repository in repositories:
-            dirlist = os.listdir(repository)
-            dirlist.sort()
+            dirlist = self.getDatabaseVersions(repository)
+            if os.path.isdir(repository):
+                dirlist += os.listdir(repository)
+            dirlist = sorted(set(dirlist))
             appVersions = set(app.versions)
             for dir in dirlist:
                 dirVersions = dir.split(".")
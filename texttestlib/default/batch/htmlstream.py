@@ -0,0 +1,96 @@
+"""
+Writing HTMLgen documents a piece at a time, so that large reports never exist in memory as one big tree
+of objects, or one big string, before they are written. Produces the same markup as HTMLgen itself.
+"""
+
+from texttestlib.default.batch import HTMLgen
+
+
+class Markup(str):
+    # HTMLgen only escapes plain strings, so text of this type is inserted as it is
+    pass
+
+
+def markup(tagClass, *contents, **attrs):
+    """ The text an instance of the HTMLgen tag class would produce, without creating one """
+    attrDict = dict(tagClass.attr_dict)
+    for name, value in attrs.items():
+        attrDict[name] = ' %s="%s"' % (name, value)
+    escape = tagClass.html_escape == "ON"
+    text = "".join((HTMLgen.escape(item) if escape and type(item) is str else str(item) for item in contents))
+    return Markup("<" + tagClass.tagname + tagClass.attr_template % attrDict + ">" + text +
+                  "</" + tagClass.tagname + ">" + tagClass.trailer)
+
+
+def element(htmlObject):
+    # For the simpler objects, just convert them straight away
+    return Markup(str(htmlObject))
+
+
+class StreamedRows:
+    """ Table rows that aren't generated until the table is written.
+    rowMethod is called with each of the argument tuples in turn, and returns a list of rows """
+
+    def __init__(self, rowMethod, argTuples):
+        self.rowMethod = rowMethod
+        self.argTuples = argTuples
+
+    def __iter__(self):
+        for args in self.argTuples:
+            yield from self.rowMethod(*args)
+
+    def __str__(self):
+        return "".join(self)
+
+
+class StreamedSection:
+    """ Document content that isn't generated until it is written. Behaves like an HTMLgen.Container
+    holding whatever the method returns """
+
+    def __init__(self, method, *args):
+        self.method = method
+        self.args = args
+
+    def __iter__(self):
+        return iter(self.method(*self.args))
+
+    def __str__(self):
+        return "".join((str(item) + "\n" for item in self))
+
+
+class StreamingTable(HTMLgen.TableLite):
+    def writeTo(self, f):
+        f.write("<" + self.tagname + self.attr_template % self.attr_dict + ">")
+        for item in self.contents:
+            if isinstance(item, StreamedRows):
+                for row in item:
+                    f.write(row)
+            elif type(item) is str:
+                f.write(HTMLgen.escape(item))
+            else:
+                f.write(str(item))
+        f.write("</" + self.tagname + ">" + self.trailer)
+
+
+def writeElement(f, item):
+    if isinstance(item, StreamingTable):
+        item.writeTo(f)
+    elif isinstance(item, StreamedSection):
+        for subItem in item:
+            writeElement(f, subItem)
+            f.write("\n")
+    else:
+        f.write(str(item))
+
+
+def writeDocument(document, fileName):
+    """ Equivalent to document.write(fileName) for an HTMLgen.SimpleDocument """
+    with open(HTMLgen.mpath(fileName), "w") as f:
+        f.write(document.get_doc_type())
+        f.write("\n<!-- This file generated using Python HTMLgen module. -->\n")
+        f.write(document.html_head())
+        f.write(document.html_body_tag())
+        for item in document.contents:
+            writeElement(f, item)
+            f.write("\n")
+        f.write("\n</BODY> </HTML>\n")
@@ -0,0 +1,175 @@
+"""
+Optional SQLite store for the historical batch results, as an alternative to the teststate files and
+succeeded_runs files written into the batch result repository directory tree.
+Everything lives in one file at the top of the repository, indexed by application, version, test and run.
+"""
+
+import os
+import sqlite3
+from io import BytesIO
+from threading import Lock
+from texttestlib import plugins
+
+
+def getNewPerformance(state, stem):
+    if hasattr(state, "findComparison"):
+        fileComp = state.findComparison(stem, includeSuccess=True)[0]
+        if fileComp and hasattr(fileComp, "getNewPerformance"):
+            try:
+                return fileComp.getNewPerformance()
+            except (ValueError, IndexError):
+                pass
+
+
+def makeStoredPath(testPath):
+    # Always stored with "/", so a database written on one platform can be read on another
+    return testPath.replace(os.sep, "/")
+
+
+def makeSuccessText(briefText, hosts):
+    # Same format as lines in the succeeded_runs files, without the run tag
+    text = briefText + " " if briefText else ""
+    return text + hosts
+
+
+class ResultDatabase:
+    fileName = "results.db"
+    instances = {}
+    schema = """
+CREATE TABLE IF NOT EXISTS results (
+    app TEXT NOT NULL,
+    version TEXT NOT NULL,
+    test TEXT NOT NULL,
+    run TEXT NOT NULL,
+    category TEXT NOT NULL,
+    brief_text TEXT NOT NULL,
+    hosts TEXT NOT NULL,
+    performance REAL,
+    state BLOB,
+    PRIMARY KEY (app, version, test, run)
+);
+CREATE INDEX IF NOT EXISTS results_by_run ON results (app, version, run);
+"""
+
+    @classmethod
+    def forRepository(cls, repository, create=False):
+        # Repository is the top level, i.e. what batch_result_repository points at
+        path = os.path.join(repository, cls.fileName)
+        if path not in cls.instances:
+            if not create and not os.path.isfile(path):
+                return
+            plugins.ensureDirExistsForFile(path)
+            cls.instances[path] = cls(path)
+        return cls.instances[path]
+
+    @classmethod
+    def forAppDirectory(cls, appDir):
+        # The directory the files would be under, i.e. <repository>/<app name>
+        repository, appName = os.path.split(appDir)
+        return cls.forRepository(repository), appName
+
+    def __init__(self, path):
+        self.path = path
+        # Results can be saved from several threads, so share one connection between them
+        self.lock = Lock()
+        self.connection = sqlite3.connect(path, timeout=60, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript(self.schema)
+
+    def addResult(self, appName, version, testPath, run, state, stateData, performance=None):
+        hosts = ", ".join(state.executionHosts)
+        return self.insert(appName, version, makeStoredPath(testPath), run, state.category, state.briefText, hosts, performance, stateData)
+
+    def addSuccess(self, appName, version, testPath, run, successText):
+        from .testoverview import parseState
+        briefText, hosts = parseState(successText)
+        return self.insert(appName, version, makeStoredPath(testPath), run, "success", briefText.strip(), ", ".join(hosts), None, None)
+
+    def insert(self, *row):
+        try:
+            with self.lock, self.connection:
+                self.connection.execute("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", row)
+            return True
+        except sqlite3.IntegrityError:
+            plugins.printWarning("Result already exists in " + self.path + " for test " + row[2] +
+                                 " in run " + row[3] + " - not overwriting!")
+            return False
+
+    def getVersions(self, appName):
+        with self.lock:
+            cursor = self.connection.execute("SELECT DISTINCT version FROM results WHERE app = ?", (appName,))
+            return [row[0] for row in cursor]
+
+    def getRunSignatures(self, appName, version):
+        # Something that changes whenever the results for the run change
+        with self.lock:
+            cursor = self.connection.execute("SELECT run, COUNT(*), MAX(rowid) FROM results WHERE app = ? AND version = ? " +
+                                             "GROUP BY run", (appName, version))
+            return {row[0]: row[1:] for row in cursor}
+
+    def getResults(self, appName, version, runs=[]):
+        # Returns (test, run, state), where succeeded tests without stored state get the succeeded_runs text.
+        # Test paths are separated by "/"
+        query = "SELECT test, run, category, brief_text, hosts, state FROM results WHERE app = ? AND version = ?"
+        with self.lock, self.connection:
+            if runs:
+                # Could be more runs than SQLite allows parameters in one statement, so join with a table of them
+                self.connection.execute("CREATE TEMP TABLE IF NOT EXISTS wanted_runs (run TEXT PRIMARY KEY)")
+                self.connection.execute("DELETE FROM wanted_runs")
+                self.connection.executemany("INSERT OR IGNORE INTO wanted_runs VALUES (?)", [(run,) for run in runs])
+                query += " AND run IN (SELECT run FROM wanted_runs)"
+            rows = self.connection.execute(query + " ORDER BY test, run", (appName, version)).fetchall()
+        for testPath, run, category, briefText, hosts, stateData in rows:
+            if stateData is None:
+                yield testPath, run, makeSuccessText(briefText, hosts)
+            else:
+                yield testPath, run, self.readState(stateData)
+
+    def readState(self, stateData):
+        from .testoverview import GenerateWebPages
+        try:
+            state = plugins.getNewTestStateFromFile(BytesIO(stateData))
+            if isinstance(state, plugins.TestState):
+                return state
+            else:
+                return GenerateWebPages.readErrorState("Incorrect type for state object.")
+        except Exception as e:
+            return GenerateWebPages.readErrorState("Stack info follows:\n" + str(e))
+
+    def getRuns(self, appName, version):
+        with self.lock:
+            cursor = self.connection.execute("SELECT DISTINCT run FROM results WHERE app = ? AND version = ?", (appName, version))
+            return [row[0] for row in cursor]
+
+    def moveRuns(self, appName, version, runs, targetDatabase):
+        # Returns the number of results moved
+        rows = []
+        with self.lock:
+            for run in runs:
+                rows += self.connection.execute("SELECT * FROM results WHERE app = ? AND version = ? AND run = ?",
+                                                (appName, version, run)).fetchall()
+        with targetDatabase.lock, targetDatabase.connection:
+            targetDatabase.connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)", rows)
+        self.removeRuns(appName, version, runs)
+        return len(rows)
+
+    def removeSucceededStates(self):
+        # The columns say all there is to say about a success, as in the succeeded_runs files. Returns how many were removed
+        with self.lock:
+            with self.connection:
+                cursor = self.connection.execute("UPDATE results SET state = NULL WHERE category = 'success' AND state IS NOT NULL")
+            count = cursor.rowcount
+            if count:
+                # Otherwise the file stays the same size
+                self.connection.execute("VACUUM")
+        return count
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+        self.instances.pop(self.path, None)
+
+    def removeRuns(self, appName, version, runs):
+        with self.lock, self.connection:
+            self.connection.executemany("DELETE FROM results WHERE app = ? AND version = ? AND run = ?",
+                                        [(appName, version, run) for run in runs])
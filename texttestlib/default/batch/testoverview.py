@@ -7,13 +7,18 @@ import html
 import sys
 import logging
 import locale
+import json
+import hashlib
 from texttestlib.default.batch import HTMLgen, HTMLcolors
+from texttestlib.default.batch.htmlstream import Markup, markup, element, writeDocument, \
+    StreamedRows, StreamedSection, StreamingTable
 from texttestlib.default.batch.ci import CIPlatform
-from texttestlib import plugins
+from texttestlib import plugins, texttest_version
 from collections import OrderedDict
 from glob import glob
 from datetime import datetime, timedelta
 from .batchutils import convertToUrl, getEnvironmentFromRunFiles
+from .resultdatabase import ResultDatabase
 HTMLgen.PRINTECHO = 0
 
 
@@ -76,7 +81,7 @@ class TitleWithDateStamp:
 
 class GenerateWebPages(object):
     def __init__(self, getConfigValue, pageDir, resourceNames,
-                 pageTitle, pageSubTitles, pageVersion, extraVersions, descriptionInfo):
+                 pageTitle, pageSubTitles, pageVersion, extraVersions, descriptionInfo, reportConfig=[]):
         self.pageTitle = pageTitle
         self.pageSubTitles = pageSubTitles
         self.pageVersion = pageVersion
@@ -87,6 +92,7 @@ class GenerateWebPages(object):
         self.getConfigValue = getConfigValue
         self.resourceNames = resourceNames
         self.descriptionInfo = descriptionInfo
+        self.reportConfig = reportConfig
         self.diag = logging.getLogger("GenerateWebPages")
 
     def makeSelectors(self, subPageNames, tags=[]):
@@ -102,9 +108,12 @@ class GenerateWebPages(object):
 
     def removeUnused(self, unused, tagData):
         successTags = {}
+        databaseTags = {}
         for tag in unused:
             for fn in tagData.get(tag):
-                if os.path.basename(fn).startswith("teststate_"):
+                if isinstance(fn, tuple):
+                    databaseTags.setdefault(fn, []).append(tag)
+                elif os.path.basename(fn).startswith("teststate_"):
                     os.remove(fn)
                 else:
                     successTags.setdefault(fn, []).append(tag)
@@ -119,16 +128,21 @@ class GenerateWebPages(object):
             with open(fn, "w") as writeFile:
                 for line in linesToKeep:
                     writeFile.write(line)
+        for (database, appName, version), tagsToRemove in databaseTags.items():
+            database.removeRuns(appName, version, tagsToRemove)
 
     def generate(self, repositoryDirs, subPageNames, archiveUnused):
         minorVersionHeader = HTMLgen.Container()
         allMonthSelectors = set()
         latestMonth = None
         pageToGraphs = {}
+        versionData = OrderedDict()
         for version, repositoryDirInfo in list(repositoryDirs.items()):
-            self.diag.info("Generating " + version)
-            tagData, stateFiles, successFiles = self.findTestStateFilesAndTags(repositoryDirInfo)
-            if len(stateFiles) > 0 or len(successFiles) > 0:
+            self.diag.info("Scanning " + version)
+            tagInputs = {}
+            tagData, stateFiles, successFiles = self.findTestStateFilesAndTags(repositoryDirInfo, tagInputs)
+            databaseVersions = self.findDatabaseVersionsAndTags(repositoryDirInfo, tagData, tagInputs)
+            if len(stateFiles) > 0 or len(successFiles) > 0 or len(databaseVersions) > 0:
                 tags = list(tagData.keys())
                 tags.sort(key=self.tagSortKey)
                 selectors = self.makeSelectors(subPageNames, tags)
@@ -160,74 +174,112 @@ class GenerateWebPages(object):
                             "(To disable automatic repository cleaning in future, please run with the --manualarchive flag when collating the HTML report.)")
                         self.removeUnused(unusedTags, tagData)
 
-                loggedTests = OrderedDict()
-                categoryHandlers = {}
-                self.diag.info("Processing " + str(len(stateFiles)) + " teststate files")
-                relevantFiles = 0
-                for stateFile, repository in stateFiles:
-                    tag = self.getTagFromFile(stateFile)
-                    if len(tags) == 0 or tag in tags:
-                        relevantFiles += 1
-                        testId, state, extraVersion = self.processTestStateFile(stateFile, repository)
-                        loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
-                            testId, OrderedDict())[tag] = state
-                        categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
-                            testId, state.category, extraVersion, state)
-                        if relevantFiles % 100 == 0:
-                            self.diag.info("- Processed " + str(relevantFiles) + " files with matching tags so far")
-                self.diag.info("Processed " + str(relevantFiles) + " relevant teststate files")
-                self.diag.info("Processing " + str(len(successFiles)) + " success files")
-                for successFile, repository in successFiles:
-                    testId = self.getTestIdentifier(successFile, repository)
-                    extraVersion = self.findExtraVersion(repository)
-                    with open(successFile) as f:
-                        fileTags = set()
-                        for line in f:
-                            parts = line.strip().split(" ", 1)
-                            if len(parts) != 2:
-                                continue
-                            tag, text = parts
-                            if tag in fileTags:
-                                sys.stderr.write("WARNING: more than one result present for tag '" +
-                                                 tag + "' in file " + successFile + "!\n")
-                                sys.stderr.write("Ignoring later ones\n")
-                                continue
-
-                            fileTags.add(tag)
-                            if len(tags) == 0 or tag in tags:
-                                loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
-                                    testId, OrderedDict())[tag] = text
-                                categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
-                                    testId, "success", extraVersion, text)
-                self.diag.info("Processed " + str(len(successFiles)) + " success files")
-                versionToShow = self.removePageVersion(version)
-                hasData = False
-                for sel in selectors:
-                    filePath = self.getPageFilePath(sel)
-                    if filePath in self.pagesOverview:
-                        page, pageColours = self.pagesOverview[filePath]
-                    else:
-                        page = self.createPage()
-                        pageColours = {"last_column": set(), "all_columns": set()}
-                        self.pagesOverview[filePath] = page, pageColours
-
-                    tableHeader = self.getTableHeader(version, repositoryDirs)
-                    heading = self.getHeading(versionToShow)
-                    hasNewData, graphLink, tableColours = self.addTable(page, self.resourceNames, categoryHandlers, version,
-                                                                        loggedTests, sel, tableHeader, filePath, heading, repositoryDirInfo)
-                    hasData |= hasNewData
-                    for colourGroupKey in tableColours:
-                        pageColours[colourGroupKey].update(tableColours[colourGroupKey])
-                    if graphLink:
-                        pageToGraphs.setdefault(page, []).append(graphLink)
-
-                if hasData and versionToShow:
-                    link = HTMLgen.Href("#" + version, versionToShow)
-                    minorVersionHeader.append(link)
-
-                # put them in reverse order, most relevant first
-                linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
-                for tag in tags:
+                versionData[version] = repositoryDirInfo, stateFiles, successFiles, databaseVersions, \
+                    tags, selectors, allSelectors, tagInputs
+
+        if len(allMonthSelectors) == 1:
+            # Don't want just one month, no navigation possible
+            prevMonth = list(allMonthSelectors)[0].getPreviousMonthSelector()
+            allMonthSelectors.add(prevMonth)
+
+        manifest = PageManifest(self.pageDir, self.pageVersion)
+        stalePages, staleDetails = self.findStalePages(manifest, versionData, allMonthSelectors, subPageNames)
+        if len(versionData) > 0 and len(stalePages) == 0 and len(staleDetails) == 0:
+            plugins.log.info("No new results since the pages were last generated, not regenerating them.")
+            return
+
+        for version, (repositoryDirInfo, stateFiles, successFiles, databaseVersions,
+                      tags, selectors, allSelectors, tagInputs) in versionData.items():
+            self.diag.info("Generating " + version)
+            # Only read the results that will appear on pages we're regenerating
+            tagsToLoad = set(tag for tag in tags if tag in staleDetails)
+            for sel in selectors:
+                if self.getPageFilePath(sel) in stalePages:
+                    tagsToLoad.update(sel.selectedTags)
+            loggedTests = OrderedDict()
+            categoryHandlers = {}
+            self.diag.info("Processing " + str(len(stateFiles)) + " teststate files")
+            relevantFiles = 0
+            for stateFile, repository in stateFiles:
+                tag = self.getTagFromFile(stateFile)
+                if tag in tagsToLoad:
+                    relevantFiles += 1
+                    testId, state, extraVersion = self.processTestStateFile(stateFile, repository)
+                    loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
+                        testId, OrderedDict())[tag] = state
+                    categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
+                        testId, state.category, extraVersion, state)
+                    if relevantFiles % 100 == 0:
+                        self.diag.info("- Processed " + str(relevantFiles) + " files with matching tags so far")
+            self.diag.info("Processed " + str(relevantFiles) + " relevant teststate files")
+            self.diag.info("Processing " + str(len(successFiles)) + " success files")
+            for successFile, repository in successFiles:
+                testId = self.getTestIdentifier(successFile, repository)
+                extraVersion = self.findExtraVersion(repository)
+                with open(successFile) as f:
+                    fileTags = set()
+                    for line in f:
+                        parts = line.strip().split(" ", 1)
+                        if len(parts) != 2:
+                            continue
+                        tag, text = parts
+                        if tag in fileTags:
+                            sys.stderr.write("WARNING: more than one result present for tag '" +
+                                             tag + "' in file " + successFile + "!\n")
+                            sys.stderr.write("Ignoring later ones\n")
+                            continue
+
+                        fileTags.add(tag)
+                        if tag in tagsToLoad:
+                            loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
+                                testId, OrderedDict())[tag] = text
+                            categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
+                                testId, "success", extraVersion, text)
+            self.diag.info("Processed " + str(len(successFiles)) + " success files")
+            for database, appName, dbVersion, repository in databaseVersions:
+                extraVersion = self.findExtraVersion(repository)
+                # Only ask the database for the runs we're going to show
+                for testPath, tag, state in database.getResults(appName, dbVersion, sorted(tagsToLoad)):
+                    testId = testPath.replace("/", " ")
+                    category = state.category if hasattr(state, "category") else "success"
+                    loggedTests.setdefault(extraVersion, OrderedDict()).setdefault(
+                        testId, OrderedDict())[tag] = state
+                    categoryHandlers.setdefault(tag, CategoryHandler()).registerInCategory(
+                        testId, category, extraVersion, state)
+            self.diag.info("Processed results from " + str(len(databaseVersions)) + " database versions")
+            versionToShow = self.removePageVersion(version)
+            hasData = False
+            for sel in selectors:
+                filePath = self.getPageFilePath(sel)
+                if filePath not in stalePages:
+                    # Not regenerating it, just note whether it has anything for this version
+                    hasData |= any((tag in tagInputs for tag in sel.selectedTags))
+                    continue
+                if filePath in self.pagesOverview:
+                    page, pageColours = self.pagesOverview[filePath]
+                else:
+                    page = self.createPage()
+                    pageColours = {"last_column": set(), "all_columns": set()}
+                    self.pagesOverview[filePath] = page, pageColours
+
+                tableHeader = self.getTableHeader(version, repositoryDirs)
+                heading = self.getHeading(versionToShow)
+                hasNewData, graphLink, tableColours = self.addTable(page, self.resourceNames, categoryHandlers, version,
+                                                                    loggedTests, sel, tableHeader, filePath, heading, repositoryDirInfo)
+                hasData |= hasNewData
+                for colourGroupKey in tableColours:
+                    pageColours[colourGroupKey].update(tableColours[colourGroupKey])
+                if graphLink:
+                    pageToGraphs.setdefault(page, []).append(graphLink)
+
+            if hasData and versionToShow:
+                link = HTMLgen.Href("#" + version, versionToShow)
+                minorVersionHeader.append(link)
+
+            # put them in reverse order, most relevant first
+            linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
+            for tag in tags:
+                if tag in staleDetails:
                     details = self.pagesDetails.setdefault(tag, TestDetails(tag, self.pageTitle, self.pageSubTitles))
                     details.addVersionSection(version, categoryHandlers[tag], linkFromDetailsToOverview)
 
@@ -238,11 +290,6 @@ class GenerateWebPages(object):
             selContainer.append(HTMLgen.Href(target, linkName))
 
         monthContainer = HTMLgen.Container()
-        if len(allMonthSelectors) == 1:
-            # Don't want just one month, no navigation possible
-            prevMonth = list(allMonthSelectors)[0].getPreviousMonthSelector()
-            allMonthSelectors.add(prevMonth)
-
         for sel in sorted(allMonthSelectors, key=lambda s: s.sortKey()):
             target, linkName = sel.getLinkInfo(self.pageVersion)
             monthContainer.append(HTMLgen.Href(target, linkName))
@@ -265,6 +312,38 @@ class GenerateWebPages(object):
                 page.script = self.getFilterScripts(pageColours)
 
         self.writePages()
+        for filePath in self.pagesOverview:
+            manifest.update(filePath, stalePages[filePath])
+        for tag in self.pagesDetails:
+            manifest.update(os.path.join(self.pageDir, getDetailPageName(self.pageVersion, tag)), staleDetails[tag])
+        manifest.write()
+
+    def findStalePages(self, manifest, versionData, allMonthSelectors, subPageNames):
+        # Work out what each page would be made from, and compare with what it was made from last time
+        monthLinks = [sel.getLinkInfo(self.pageVersion) for sel in sorted(allMonthSelectors, key=lambda s: s.sortKey())]
+        commonInputs = [monthLinks, subPageNames, list(versionData.keys()), self.resourceNames,
+                        sorted(self.descriptionInfo.items()), self.pageTitle, self.reportConfig]
+        pageInputs, detailInputs = OrderedDict(), OrderedDict()
+        for version, (_, _, _, _, tags, selectors, allSelectors, tagInputs) in versionData.items():
+            for sel in selectors:
+                selectorInputs = [(tag, tagInputs.get(tag)) for tag in sel.selectedTags]
+                pageInputs.setdefault(self.getPageFilePath(sel), list(commonInputs)).append((version, selectorInputs))
+            linkFromDetailsToOverview = [sel.getLinkInfo(self.pageVersion) for sel in allSelectors]
+            for tag in tags:
+                detailInputs.setdefault(tag, [self.pageTitle, self.reportConfig]).append((version, tagInputs.get(tag),
+                                                                          linkFromDetailsToOverview))
+        stalePages, staleDetails = {}, {}
+        for filePath, inputs in pageInputs.items():
+            signature = manifest.makeSignature(inputs)
+            if manifest.isStale(filePath, signature):
+                stalePages[filePath] = signature
+        for tag, inputs in detailInputs.items():
+            signature = manifest.makeSignature(inputs)
+            if manifest.isStale(os.path.join(self.pageDir, getDetailPageName(self.pageVersion, tag)), signature):
+                staleDetails[tag] = signature
+        self.diag.info("Regenerating " + str(len(stalePages)) + " of " + str(len(pageInputs)) + " overview pages and " +
+                       str(len(staleDetails)) + " of " + str(len(detailInputs)) + " detail pages")
+        return stalePages, staleDetails
 
     def getFilterScripts(self, pageColours):
         finder = ColourFinder(self.getConfigValue)
@@ -306,7 +385,8 @@ class GenerateWebPages(object):
     def getTagFromFile(self, fileName):
         return os.path.basename(fileName).replace("teststate_", "")
 
-    def findTestStateFilesAndTags(self, repositoryDirs):
+    def findTestStateFilesAndTags(self, repositoryDirs, tagInputs):
+        # tagInputs records what the results for each tag were read from, to tell if they've changed
         tagData, stateFiles, successFiles = {}, [], []
         for _, dir in repositoryDirs:
             self.diag.info("Looking for teststate files in " + dir)
@@ -317,6 +397,8 @@ class GenerateWebPages(object):
                         tag = self.getTagFromFile(file)
                         stateFiles.append((path, dir))
                         tagData.setdefault(tag, []).append(path)
+                        fileStat = os.stat(path)
+                        tagInputs.setdefault(tag, []).append((path, fileStat.st_mtime_ns, fileStat.st_size))
                     elif file.startswith("succeeded_"):
                         successFiles.append((path, dir))
                         with open(path) as f:
@@ -325,11 +407,27 @@ class GenerateWebPages(object):
                                 if parts:
                                     tag = parts[0]
                                     tagData.setdefault(tag, []).append(path)
+                                    tagInputs.setdefault(tag, []).append((path, line))
 
             self.diag.info("Found " + str(len(stateFiles)) + " teststate files and " +
                            str(len(successFiles)) + " success files in " + dir)
         return tagData, stateFiles, successFiles
 
+    def findDatabaseVersionsAndTags(self, repositoryDirs, tagData, tagInputs):
+        databaseVersions = []
+        for _, dir in repositoryDirs:
+            appDir, version = os.path.split(dir)
+            database, appName = ResultDatabase.forAppDirectory(appDir)
+            if database is not None:
+                runSignatures = database.getRunSignatures(appName, version)
+                if runSignatures:
+                    self.diag.info("Found " + str(len(runSignatures)) + " runs in database for " + dir)
+                    databaseVersions.append((database, appName, version, dir))
+                    for tag, signature in runSignatures.items():
+                        tagData.setdefault(tag, []).append((database, appName, version))
+                        tagInputs.setdefault(tag, []).append((database.path, version, signature))
+        return databaseVersions
+
     def processTestStateFile(self, stateFile, repository):
         state = self.readState(stateFile)
         testId = self.getTestIdentifier(stateFile, repository)
@@ -437,7 +535,7 @@ class GenerateWebPages(object):
         plugins.log.info("Writing overview pages...")
         fileToUrl = self.getConfigValue("file_to_url", allSubKeys=True)
         for pageFile, (page, _) in list(self.pagesOverview.items()):
-            page.write(pageFile)
+            writeDocument(page, pageFile)
             plugins.log.info("wrote: '" + plugins.relpath(pageFile, self.pageDir) + "'")
             if fileToUrl:
                 url = convertToUrl(pageFile, fileToUrl)
@@ -467,6 +565,41 @@ class GenerateWebPages(object):
         return time.mktime(time.strptime(timePart, "%d%b%Y"))
 
 
+class PageManifest:
+    """ Records what each generated page was made from, so that pages whose results haven't changed
+    can be left alone next time. Delete the manifest file to force everything to be regenerated """
+    def __init__(self, pageDir, pageVersion):
+        self.fileName = os.path.join(pageDir, "manifest_" + pageVersion + ".json")
+        self.pageDir = pageDir
+        self.pages = {}
+        if os.path.isfile(self.fileName):
+            try:
+                with open(self.fileName) as f:
+                    info = json.load(f)
+                # A different TextTest might generate different pages from the same results
+                if info.get("texttest_version") == texttest_version.version:
+                    self.pages = info.get("pages", {})
+            except ValueError:
+                plugins.printWarning("Could not parse page manifest at " + self.fileName + ", regenerating all pages")
+
+    def makeSignature(self, inputs):
+        return hashlib.sha1(repr(inputs).encode()).hexdigest()
+
+    def getKey(self, filePath):
+        return plugins.relpath(filePath, self.pageDir)
+
+    def isStale(self, filePath, signature):
+        return not os.path.isfile(filePath) or self.pages.get(self.getKey(filePath)) != signature
+
+    def update(self, filePath, signature):
+        self.pages[self.getKey(filePath)] = signature
+
+    def write(self):
+        info = {"texttest_version": texttest_version.version, "pages": self.pages}
+        with open(self.fileName, "w") as f:
+            json.dump(info, f, indent=1, sort_keys=True)
+
+
 class TestTable:
     def __init__(self, getConfigValue, resourceNames, descriptionInfo, tags, categoryHandlers, pageVersion, version, graphFilePath):
         self.getConfigValue = getConfigValue
@@ -496,7 +629,7 @@ class TestTable:
             return False
 
     def generate(self, loggedTests, pageDir, repositoryDirs):
-        table = HTMLgen.TableLite(border=0, cellpadding=4, cellspacing=2, width="100%")
+        table = StreamingTable(border=0, cellpadding=4, cellspacing=2, width="100%")
         table.append(self.generateTableHead(repositoryDirs))
         table.append(self.generateSummaries())
         changeRow = self.generateCIChanges(pageDir)
@@ -504,14 +637,10 @@ class TestTable:
             table.append(changeRow)
         hasRows = False
         for extraVersion, testInfo in list(loggedTests.items()):
-            currRows = []
-            for test in sorted(testInfo.keys()):
-                results = testInfo[test]
-                rows = self.generateTestRows(test, extraVersion, results)
-                if rows:
-                    currRows += rows
-
-            if len(currRows) == 0:
+            # The rows themselves are only generated when the page is written
+            rowArgs = [(test, extraVersion, testInfo[test]) for test in sorted(testInfo.keys())
+                       if self.findRowColours(testInfo[test])]
+            if len(rowArgs) == 0:
                 continue
             else:
                 hasRows = True
@@ -524,8 +653,7 @@ class TestTable:
                 table.append(self.generateExtraVersionHeader(fullVersion))
                 table.append(self.generateSummaries(extraVersion))
 
-            for row in currRows:
-                table.append(row)
+            table.append(StreamedRows(self.generateTestRows, rowArgs))
 
         if hasRows:
             table.append(HTMLgen.BR())
@@ -604,39 +732,49 @@ class TestTable:
         localeEncoding = locale.getdefaultlocale()[1] or "utf-8"
         return str(text.encode("ascii", "xmlcharrefreplace"), localeEncoding)
 
+    def findRowColours(self, results):
+        # Note the colours the test's row will use, and whether it has any data, so we needn't keep the row
+        foundData = False
+        bgcol = None
+        for tag in self.tags:
+            cellText, success, _, bgcol = self.getCellData(results.get(tag), "")
+            foundData |= not success or cellText != "N/A"
+            self.usedColours["all_columns"].add(bgcol)
+
+        if foundData:
+            self.usedColours["last_column"].add(bgcol)
+        return foundData
+
     def generateTestRows(self, testName, extraVersion, results):
         bgColour = self.colourFinder.find("row_header_bg")
         testId = makeTestId(self.version, extraVersion, testName)
         description = self.descriptionInfo.get(testName, "")
-        container = HTMLgen.Container(HTMLgen.Name(testId), testName)
+        container = Markup(str(HTMLgen.Name(testId)) + "\n" + testName + "\n")
         rows = []
-        testRow = [HTMLgen.TD(container, bgcolor=bgColour, title=self.escapeForHtml(description))]
+        testRow = [markup(HTMLgen.TD, container, bgcolor=bgColour, title=self.escapeForHtml(description))]
 
         # Don't add empty rows to the table
         foundData = False
-        bgcol = None
         for tag in self.tags:
             cellContent, bgcol, hasData = self.generateTestCell(tag, testName, testId, results)
-            testRow.append(HTMLgen.TD(cellContent, bgcolor=bgcol))
+            testRow.append(markup(HTMLgen.TD, cellContent, bgcolor=bgcol))
             foundData |= hasData
-            self.usedColours["all_columns"].add(bgcol)
 
         if foundData:
-            self.usedColours["last_column"].add(bgcol)
-            rows.append(HTMLgen.TR(*testRow))
+            rows.append(markup(HTMLgen.TR, *testRow))
         else:
             return rows
 
         for resourceName in self.resourceNames:
             foundData = False
-            resourceRow = [HTMLgen.TD(HTMLgen.Emphasis("(" + resourceName + ")"), align="right")]
+            resourceRow = [markup(HTMLgen.TD, markup(HTMLgen.Emphasis, "(" + resourceName + ")"), align="right")]
             for tag in self.tags:
                 cellContent, bgcol, hasData = self.generateTestCell(tag, testName, testId, results, resourceName)
-                resourceRow.append(HTMLgen.TD(HTMLgen.Emphasis(cellContent), bgcolor=bgcol, align="right"))
+                resourceRow.append(markup(HTMLgen.TD, markup(HTMLgen.Emphasis, cellContent), bgcolor=bgcol, align="right"))
                 foundData |= hasData
 
             if foundData:
-                rows.append(HTMLgen.TR(*resourceRow))
+                rows.append(markup(HTMLgen.TR, *resourceRow))
         return rows
 
     def getCellData(self, state, resourceName):
@@ -681,13 +819,13 @@ class TestTable:
     def generateTestCell(self, tag, testName, testId, results, resourceName=""):
         state = results.get(tag)
         cellText, success, fgcol, bgcol = self.getCellData(state, resourceName)
-        cellContent = HTMLgen.Font(cellText, color=fgcol)
+        cellContent = markup(HTMLgen.Font, cellText, color=fgcol)
         if success:
             return cellContent, bgcol, cellText != "N/A"
         else:
             linkTarget = getDetailPageName(self.pageVersion, tag) + "#" + testId
             tooltip = "'" + testName + "' failure for " + getDisplayText(tag)
-            return HTMLgen.Href(linkTarget, cellContent, title=tooltip, style="color:black"), bgcol, True
+            return element(HTMLgen.Href(linkTarget, cellContent, title=tooltip, style="color:black")), bgcol, True
 
     def getBackgroundColourKey(self, category):
         if category == "success":
@@ -790,16 +928,19 @@ class TestDetails:
 
     def addVersionSection(self, version, categoryHandler, linkFromDetailsToOverview):
         self.totalCategoryHandler.update(categoryHandler)
-        container = HTMLgen.Container()
-        container.append(HTMLgen.HR())
-        container.append(self.getSummaryHeading(version, categoryHandler))
+        # Generated when written, a section at a time
+        self.versionSections.append(StreamedSection(self.generateVersionSection, version,
+                                                    categoryHandler, linkFromDetailsToOverview))
+
+    def generateVersionSection(self, version, categoryHandler, linkFromDetailsToOverview):
+        yield HTMLgen.HR()
+        yield self.getSummaryHeading(version, categoryHandler)
         for desc, testInfo in categoryHandler.getTestsWithDescriptions():
             fullDescription = self.getFullDescription(testInfo, version, linkFromDetailsToOverview)
             if fullDescription:
-                container.append(HTMLgen.Name(version + desc))
-                container.append(HTMLgen.Heading(3, "Detailed information for the tests that " + desc + ":"))
-                container.append(fullDescription)
-        self.versionSections.append(container)
+                yield HTMLgen.Name(version + desc)
+                yield HTMLgen.Heading(3, "Detailed information for the tests that " + desc + ":")
+                yield fullDescription
 
     def getSummaryHeading(self, version, categoryHandler):
         return HTMLgen.Heading(2, version + ": " + categoryHandler.generateTextSummary())
@@ -810,7 +951,7 @@ class TestDetails:
         for sect in self.versionSections:
             self.document.append(sect)
         self.versionSections = []  # In case we get called again
-        self.document.write(fileName)
+        writeDocument(self.document, fileName)
 
     def getFreeTextData(self, tests):
         data = OrderedDict()
@@ -5,16 +5,31 @@ import time
 import subprocess
 import logging
 import re
-from texttestlib import plugins
+from texttestlib import plugins, stateformat
+from texttestlib.default import textdiff
 from shutil import copyfile
 
 from fnmatch import fnmatch
 
 
+def getFreeTextBody(comparison):
+    # For working out the text in a separate process
+    return comparison._getFreeTextBody()
+
+
 class FileComparison:
     SAME = 0
     DIFFERENT = 1
     APPROVED = 2
+    # What gets written in state files, see stateformat
+    stateFields = ("stem", "stdFile", "stdCmpFile", "tmpFile", "tmpCmpFile", "differenceCache", "severity",
+                   "displayPriority", "binaryFile", "previewGenerator", "textDiffTool", "textDiffToolMaxSize",
+                   "freeTextBody", "largeFileSize", "builtinTextDiff")
+    lazyStateFields = ("freeTextBody",)
+    # Files at least this big are never read into memory in full. Not known for comparisons from pickled state files
+    largeFileSize = None
+    # Whether previews for the standard diff formats are made by textdiff rather than the text_diff_program
+    builtinTextDiff = False
 
     def __init__(self, test, stem, standardFile, tmpFile, testInProgress=False, **kw):
         self.stdFile = standardFile
@@ -37,6 +52,8 @@ class FileComparison:
         self.previewGenerator = plugins.PreviewGenerator(maxWidth, maxLength)
         self.textDiffTool = test.getConfigValue("text_diff_program")
         self.textDiffToolMaxSize = plugins.parseBytes(test.getCompositeConfigValue("max_file_size", self.textDiffTool))
+        self.largeFileSize = plugins.parseBytes(test.getConfigValue("large_file_size"))
+        self.builtinTextDiff = test.getConfigValue("builtin_text_diff_previews") == "true"
         self.freeTextBody = None
         # subclasses may override if they don't want to store in this way
         self.cacheDifferences(test, testInProgress)
@@ -131,6 +148,7 @@ class FileComparison:
 
     def __getstate__(self):
         # don't pickle the diagnostics
+        stateformat.loadLazyFields(self)
         state = {}
         for var, value in list(self.__dict__.items()):
             if var != "diag" and var != "recalculationTime":
@@ -142,6 +160,14 @@ class FileComparison:
         self.diag = logging.getLogger("TestComparison")
         self.recalculationTime = None
 
+    def __getattr__(self, name):
+        # The preview of the differences isn't decoded from a state file until it's needed
+        return stateformat.loadLazyField(self, name)
+
+    def __setattr__(self, name, value):
+        stateformat.discardLazyField(self, name)
+        object.__setattr__(self, name, value)
+
     def __repr__(self):
         return self.stem
 
@@ -253,6 +279,9 @@ class FileComparison:
             self.diag.info("Caching differences " + repr(self.stdCmpFile) + " " +
                            repr(self.tmpCmpFile) + " = " + repr(self.differenceCache))
 
+    def isLarge(self, *fileNames):
+        return self.largeFileSize is not None and any((os.path.getsize(fileName) >= self.largeFileSize for fileName in fileNames))
+
     def cacheDifferences(self, test, testInProgress):
         self.setCmpFiles(test, testInProgress)
         self.updateDifferenceCache(self.SAME)
@@ -309,6 +338,11 @@ class FileComparison:
                           "' and re-run to see the difference in this text view.\n"
                 return self.previewGenerator.getWrappedLine(message)
 
+            if self.builtinTextDiff and textdiff.hasBuiltinFormat(self.textDiffTool):
+                diffLines = textdiff.diffFiles(self.stdCmpFile, self.tmpCmpFile, self.textDiffTool, self.previewGenerator.maxLength,
+                                               largeFiles=self.isLarge(self.stdCmpFile, self.tmpCmpFile))
+                return self.previewGenerator.getPreviewFromLines(diffLines)
+
             cmdArgs = plugins.splitcmd(self.textDiffTool) + [self.stdCmpFile, self.tmpCmpFile]
             proc = subprocess.Popen(cmdArgs, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True)
             return self.previewGenerator.getPreview(proc.stdout)
@@ -434,6 +468,8 @@ class FileComparison:
 
 
 class SplitFileComparison(FileComparison):
+    stateFields = ("parent",)
+
     def __init__(self, parent, test, stem, stdFile, *args):
         self.parent = parent
         stemToUse = stem + "/" + os.path.basename(stdFile)
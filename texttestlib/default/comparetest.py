@@ -3,10 +3,10 @@ import filecmp
 import shutil
 import logging
 from texttestlib.default import performance, knownbugs
-from texttestlib import plugins
+from texttestlib import plugins, stateformat
 from collections import OrderedDict
 from tempfile import mktemp
-from .comparefile import FileComparison, SplitFileComparison
+from .comparefile import FileComparison, SplitFileComparison, getFreeTextBody
 from fnmatch import fnmatch
 
 plugins.addCategory("success", "succeeded")
@@ -14,6 +14,10 @@ plugins.addCategory("failure", "FAILED")
 
 
 class BaseTestComparison(plugins.TestState):
+    stateFields = ("allResults", "changedResults", "newResults", "missingResults", "correctResults")
+    # Only needed in this process, not saved
+    transientFields = ("diag",)
+
     def __init__(self, category, previousInfo, completed, lifecycleChange=""):
         plugins.TestState.__init__(self, category, "", started=1, completed=completed,
                                    lifecycleChange=lifecycleChange, executionHosts=previousInfo.executionHosts)
@@ -24,6 +28,18 @@ class BaseTestComparison(plugins.TestState):
         self.correctResults = []
         self.diag = logging.getLogger("TestComparison")
 
+    def __getstate__(self):
+        # don't pickle the diagnostics
+        state = {}
+        for var, value in list(plugins.TestState.__getstate__(self).items()):
+            if var not in self.transientFields:
+                state[var] = value
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__ = state
+        self.diag = logging.getLogger("TestComparison")
+
     def hasResults(self):
         return len(self.allResults) > 0
 
@@ -159,7 +175,25 @@ class BaseTestComparison(plugins.TestState):
         return stemDict
 
 
+class LazyFreeText:
+    """ Works out the free text of a TestComparison when it is first used """
+
+    def __init__(self, comparison, prefix, variablesToStore):
+        self.comparison = comparison
+        self.prefix = prefix
+        self.variablesToStore = variablesToStore
+
+    def getText(self, *args):
+        self.comparison.makeFreeTextsInParallel()
+        return self.prefix + self.comparison.getFreeTextInfo(self.variablesToStore)
+
+
 class TestComparison(BaseTestComparison):
+    stateFields = ("failedPrediction", "appAbsPath", "appWriteDir")
+    transientFields = BaseTestComparison.transientFields + ("parallelFreeTextSettings",)
+    # Number of processes and minimum file size for working out the free text of the files in parallel
+    parallelFreeTextSettings = None
+
     def __init__(self, previousInfo, app, lifecycleChange="", copyFailedPrediction=True):
         BaseTestComparison.__init__(self, "failure", previousInfo, completed=1, lifecycleChange=lifecycleChange)
         self.failedPrediction = None
@@ -169,6 +203,34 @@ class TestComparison(BaseTestComparison):
         self.appAbsPath = app.getDirectory()
         self.appWriteDir = app.writeDirectory
 
+    def makeComparisons(self, test, ignoreMissing=False):
+        BaseTestComparison.makeComparisons(self, test, ignoreMissing)
+        processes = test.getConfigValue("file_comparison_processes")
+        if processes > 0:
+            # The free text itself is only worked out when it's first used, see LazyFreeText
+            self.parallelFreeTextSettings = processes, plugins.parseBytes(test.getConfigValue("file_comparison_parallel_size"))
+
+    def makeFreeTextsInParallel(self):
+        # Showing the differences is the slow part for large files, and each file can be done on its own
+        if self.parallelFreeTextSettings is None:
+            return
+        processes, minSize = self.parallelFreeTextSettings
+        comparisons = [comp for comp in self.changedResults + self.newResults + self.missingResults
+                       if comp.freeTextBody is None and self.getLargestFileSize(comp) >= minSize]
+        if len(comparisons) > 1:
+            pool = plugins.getProcessPool(processes)
+            futures = [pool.submit(getFreeTextBody, comp) for comp in comparisons]
+            for comp, future in zip(comparisons, futures):
+                try:
+                    comp.freeTextBody = future.result()
+                except Exception as e:
+                    # Will get worked out here instead when it's needed
+                    self.diag.info("Failed to find differences for " + comp.stem + " in a separate process : " + str(e))
+
+    def getLargestFileSize(self, comparison):
+        fileNames = [comparison.stdCmpFile, comparison.tmpCmpFile]
+        return max((os.path.getsize(f) for f in fileNames if f and os.path.isfile(f)), default=0)
+
     def categoryRepr(self):
         if self.failedPrediction:
             longDescription = self.categoryDescriptions[self.category][1]
@@ -176,18 +238,6 @@ class TestComparison(BaseTestComparison):
         else:
             return plugins.TestState.categoryRepr(self)
 
-    def __getstate__(self):
-        # don't pickle the diagnostics
-        state = {}
-        for var, value in list(self.__dict__.items()):
-            if var != "diag":
-                state[var] = value
-        return state
-
-    def __setstate__(self, state):
-        self.__dict__ = state
-        self.diag = logging.getLogger("TestComparison")
-
     def updateAfterLoad(self, app=None, updatePaths=False, newTmpPath=None):
         pathsToChange = []
         if updatePaths:
@@ -335,7 +385,7 @@ class TestComparison(BaseTestComparison):
     def categorise(self, variablesToStore=[], successOnNoResult=True):
         if self.failedPrediction:
             # Keep the category we had before
-            self.freeText += self.getFreeTextInfo(variablesToStore)
+            self.setFreeTextInfo(self.freeText, variablesToStore)
             return
         worstResult = self.getMostSevereFileComparison()
         if not worstResult:
@@ -348,7 +398,16 @@ class TestComparison(BaseTestComparison):
                 self.category = "not_started"
         else:
             self.category = worstResult.getType()
-            self.freeText = self.getFreeTextInfo(variablesToStore)
+            self.setFreeTextInfo("", variablesToStore)
+
+    def setFreeTextInfo(self, prefix, variablesToStore):
+        # Previews of the differences are slow to produce and often never looked at, e.g. in the GUI, so wait until they are.
+        # Anything that saves, sends or copies the state reads it anyway, so batch runs, which save every state, don't gain from this
+        stateformat.setLazyField(self, "freeText", LazyFreeText(self, prefix, variablesToStore))
+
+    def makeFreeTextBeforeChanges(self):
+        # The free text should describe the files as they were compared, so work it out before they change
+        stateformat.loadLazyFields(self)
 
     def getFreeTextInfo(self, variablesToStore=[]):
         texts = self.variablesToText(variablesToStore)
@@ -391,6 +450,7 @@ class TestComparison(BaseTestComparison):
 
     def save(self, test, exact=True, versionString=None, overwriteSuccessFiles=False, onlyStems=[], backupVersions=[]):
         self.diag.info("Approving " + repr(test) + " stems " + repr(onlyStems) + ", exact=" + repr(exact))
+        self.makeFreeTextBeforeChanges()
         for comparison in self.filterComparisons(self.changedResults, onlyStems):
             self.updateStatus(test, str(comparison), versionString)
             comparison.overwrite(test, exact, versionString, backupVersions)
@@ -429,6 +489,7 @@ class TestComparison(BaseTestComparison):
 
     def recalculateStdFiles(self, test):
         self.diag.info("Recalculating standard files for " + repr(test))
+        self.makeFreeTextBeforeChanges()
         test.refreshFiles()
         resultFiles, defFiles = test.listApprovedFiles(allVersions=False)
         stdFiles = self.makeStemDict(resultFiles + defFiles)
@@ -488,6 +549,8 @@ performance.PerformanceTestComparison = TestComparison
 
 
 class ProgressTestComparison(BaseTestComparison):
+    stateFields = ("runningState",)
+
     def __init__(self, previousInfo):
         BaseTestComparison.__init__(self, previousInfo.category, previousInfo,
                                     completed=0, lifecycleChange="be recalculated")
@@ -581,6 +644,9 @@ class MakeComparisons(plugins.Action):
         else:
             self.describe(suite)
 
+    def setUpSuiteInCopy(self, suite):
+        pass
+
 
 class PrintObsoleteVersions(plugins.Action):
     scriptDoc = "Lists all files with version IDs that are equivalent to a non-versioned file"
@@ -1,5 +1,12 @@
+import re
 import sys
 import difflib
+from bisect import bisect_left
+
+# Runs of the characters _getNumberAt looks at. Splitting on these gives text and numbers alternately
+_numberRunRegex = re.compile("([-+.0-9eE]+)")
+# Above this many line pairs to consider, SequenceMatcher gets too slow, so we find anchors first
+_maxMatcherSize = 1000000
 
 
 def _getNumberAt(l, pos):
@@ -30,26 +37,59 @@ def _getNumberAt(l, pos):
     return l[start:end], l[end:]
 
 
+def _withinTolerance(number1, number2, tolerance, relTolerance):
+    deviation = abs(float(number1) - float(number2))
+    if tolerance != None and deviation <= tolerance:
+        return True
+    elif relTolerance != None:
+        referenceValue = abs(float(number1))
+        if referenceValue == 0:
+            return deviation == 0
+        elif deviation / referenceValue <= relTolerance:
+            return True
+    return False
+
+
 def _fpequalAtPos(l1, l2, tolerance, relTolerance, pos):
     number1, l1 = _getNumberAt(l1, pos)
     number2, l2 = _getNumberAt(l2, pos)
     try:
-        equal = False
-        deviation = abs(float(number1) - float(number2))
-        if tolerance != None and deviation <= tolerance:
-            equal = True
-        elif relTolerance != None:
-            referenceValue = abs(float(number1))
-            if referenceValue == 0:
-                equal = (deviation == 0)
-            elif deviation / referenceValue <= relTolerance:
-                equal = True
+        equal = _withinTolerance(number1, number2, tolerance, relTolerance)
     except ValueError:
-        pass
+        equal = False
     return equal, l1, l2
 
 
+def _isWholeNumber(text):
+    # _getNumberAt would stop before the end of a run with more than one of these
+    return text.count(".") <= 1 and text.count("e") + text.count("E") <= 1
+
+
+def _fpequalTokens(l1, l2, tolerance, relTolerance):
+    # Compare the lines a number at a time: if the text between the numbers is the same, and each number
+    # is one _getNumberAt would find all of, this gives the same answer as the character-based comparison.
+    # Returns None if it can't tell
+    tokens1 = _numberRunRegex.split(l1)
+    tokens2 = _numberRunRegex.split(l2)
+    if len(tokens1) != len(tokens2) or tokens1[::2] != tokens2[::2]:
+        return
+    for number1, number2 in zip(tokens1[1::2], tokens2[1::2]):
+        if number1 != number2:
+            if not _isWholeNumber(number1) or not _isWholeNumber(number2):
+                return
+            try:
+                if not _withinTolerance(number1, number2, tolerance, relTolerance):
+                    return
+            except ValueError:
+                return
+    return True
+
+
 def _fpequal(l1, l2, tolerance, relTolerance):
+    return _fpequalTokens(l1, l2, tolerance, relTolerance) or _fpequalByChar(l1, l2, tolerance, relTolerance)
+
+
+def _fpequalByChar(l1, l2, tolerance, relTolerance):
     pos = 0
     while pos < min(len(l1), len(l2)):
         if l1[pos] != l2[pos]:
@@ -92,12 +132,91 @@ def fpfilter(fromlines, tolines, outlines, tolerance, relTolerance=None, useDiff
     if split == 'None':
         split = None
     if not useDifflib:
+        # Works through the lines as they come, so files can be passed without reading them in
+        tolines = iter(tolines)
         _cmpLines(fromlines, tolines, outlines, tolerance, relTolerance, split)
-        outlines.writelines(tolines[len(fromlines):])
+        outlines.writelines(tolines)
         return
-    s = difflib.SequenceMatcher(None, fromlines, tolines)
-    for tag, i1, i2, j1, j2 in s.get_opcodes():
+    opcodes = []
+    _alignLines(fromlines, tolines, 0, len(fromlines), 0, len(tolines), opcodes)
+    for tag, i1, i2, j1, j2 in opcodes:
         if tag == "replace" and i2 - i1 == j2 - j1:
             _cmpLines(fromlines[i1:i2], tolines[j1:j2], outlines, tolerance, relTolerance, split)
         else:
             outlines.writelines(tolines[j1:j2])
+
+
+def _findAnchors(fromlines, tolines, i1, i2, j1, j2):
+    # Lines appearing just once on each side, in an order that is the same on both sides
+    counts = {}
+    for i in range(i1, i2):
+        count, _ = counts.get(fromlines[i], (0, None))
+        counts[fromlines[i]] = count + 1, i
+    toCounts = {}
+    for j in range(j1, j2):
+        line = tolines[j]
+        if counts.get(line, (0,))[0] == 1:
+            count, _ = toCounts.get(line, (0, None))
+            toCounts[line] = count + 1, j
+    pairs = sorted((counts[line][1], j) for line, (count, j) in toCounts.items() if count == 1)
+    # Longest increasing subsequence of the positions on the 'to' side
+    tails, tailIndices, previous = [], [], []
+    for index, (i, j) in enumerate(pairs):
+        pos = bisect_left(tails, j)
+        previous.append(tailIndices[pos - 1] if pos > 0 else None)
+        if pos == len(tails):
+            tails.append(j)
+            tailIndices.append(index)
+        else:
+            tails[pos] = j
+            tailIndices[pos] = index
+    anchors = []
+    index = tailIndices[-1] if tailIndices else None
+    while index is not None:
+        anchors.append(pairs[index])
+        index = previous[index]
+    anchors.reverse()
+    return anchors
+
+
+def _alignLines(fromlines, tolines, i1, i2, j1, j2, opcodes):
+    # Produce the opcodes SequenceMatcher.get_opcodes would. Only when that would be too slow are common
+    # lines at the ends, and lines that are unique on both sides, matched up first, so SequenceMatcher is
+    # only used on the parts between
+    if (i2 - i1) * (j2 - j1) <= _maxMatcherSize:
+        matcher = difflib.SequenceMatcher(None, fromlines[i1:i2], tolines[j1:j2])
+        for tag, a1, a2, b1, b2 in matcher.get_opcodes():
+            opcodes.append((tag, i1 + a1, i1 + a2, j1 + b1, j1 + b2))
+        return
+    startI, startJ = i1, j1
+    while i1 < i2 and j1 < j2 and fromlines[i1] == tolines[j1]:
+        i1 += 1
+        j1 += 1
+    if i1 > startI:
+        opcodes.append(("equal", startI, i1, startJ, j1))
+    endI, endJ = i2, j2
+    while i2 > i1 and j2 > j1 and fromlines[i2 - 1] == tolines[j2 - 1]:
+        i2 -= 1
+        j2 -= 1
+    if i1 == i2 and j1 < j2:
+        opcodes.append(("insert", i1, i2, j1, j2))
+    elif j1 == j2 and i1 < i2:
+        opcodes.append(("delete", i1, i2, j1, j2))
+    elif i1 < i2:
+        if (i2 - i1) * (j2 - j1) <= _maxMatcherSize:
+            matcher = difflib.SequenceMatcher(None, fromlines[i1:i2], tolines[j1:j2])
+            for tag, a1, a2, b1, b2 in matcher.get_opcodes():
+                opcodes.append((tag, i1 + a1, i1 + a2, j1 + b1, j1 + b2))
+        else:
+            anchors = _findAnchors(fromlines, tolines, i1, i2, j1, j2)
+            if anchors:
+                prevI, prevJ = i1, j1
+                for anchorI, anchorJ in anchors:
+                    _alignLines(fromlines, tolines, prevI, anchorI, prevJ, anchorJ, opcodes)
+                    opcodes.append(("equal", anchorI, anchorI + 1, anchorJ, anchorJ + 1))
+                    prevI, prevJ = anchorI + 1, anchorJ + 1
+                _alignLines(fromlines, tolines, prevI, i2, prevJ, j2, opcodes)
+            else:
+                opcodes.append(("replace", i1, i2, j1, j2))
+    if i2 < endI:
+        opcodes.append(("equal", i2, endI, j2, endJ))
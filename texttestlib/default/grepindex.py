@@ -0,0 +1,113 @@
+"""
+Index of which three-character sequences ("trigrams") each standard file contains, so that selecting
+tests with -grep can skip reading the files that can't possibly contain the text searched for.
+Entries are kept per file along with its modification time and size, and anything that has changed
+since it was indexed is read again, so the index just gets brought up to date as it is used.
+Files bigger than a given size aren't indexed at all, as their trigrams would take too much space.
+"""
+
+import os
+import time
+import logging
+from pickle import dump, load, HIGHEST_PROTOCOL
+from threading import Lock
+from texttestlib import plugins
+
+
+def getTrigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def getFileTrigrams(fileName, chunkSize=1048576):
+    trigrams = set()
+    # Read it the same way GrepFilter does
+    with open(fileName, errors="ignore") as f:
+        # Keep the last two characters of each chunk, so trigrams across the boundary aren't lost
+        overlap = ""
+        for chunk in iter(lambda: f.read(chunkSize), ""):
+            text = overlap + chunk
+            trigrams.update(getTrigrams(text))
+            overlap = text[-2:]
+    return frozenset(trigrams)
+
+
+class GrepIndex:
+    formatVersion = 1
+    # Anything changed more recently than this might change again without its time changing
+    minimumAge = 2
+    instances = {}
+
+    @classmethod
+    def forFile(cls, fileName, maxFileSize=None):
+        if fileName not in cls.instances:
+            cls.instances[fileName] = cls(fileName)
+        index = cls.instances[fileName]
+        index.maxFileSize = maxFileSize
+        return index
+
+    @classmethod
+    def saveAll(cls):
+        for index in cls.instances.values():
+            index.save()
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.maxFileSize = None
+        self.diag = logging.getLogger("Grep index")
+        self.entries = {}
+        self.changed = False
+        self.lock = Lock()
+        self.read()
+
+    def read(self):
+        try:
+            with open(self.fileName, "rb") as f:
+                data = load(f)
+            if data.get("version") == self.formatVersion:
+                self.entries = data["entries"]
+                self.diag.info("Read index of " + str(len(self.entries)) + " files from " + self.fileName)
+        except Exception as e:
+            # Missing or unreadable, we just start again
+            self.diag.info("Could not read index from " + self.fileName + " : " + str(e))
+
+    def save(self):
+        with self.lock:
+            if not self.changed:
+                return
+            data = {"version": self.formatVersion, "entries": dict(self.entries)}
+            self.changed = False
+        try:
+            plugins.ensureDirExistsForFile(self.fileName)
+            tmpFileName = self.fileName + "." + str(os.getpid())
+            with open(tmpFileName, "wb") as f:
+                dump(data, f, protocol=HIGHEST_PROTOCOL)
+            os.replace(tmpFileName, self.fileName)
+        except OSError as e:
+            plugins.printWarning("Could not write grep index to " + self.fileName + " : " + str(e))
+
+    def getTrigrams(self, fileName):
+        statInfo = os.stat(fileName)
+        if self.maxFileSize is not None and statInfo.st_size > self.maxFileSize:
+            return
+        signature = statInfo.st_mtime_ns, statInfo.st_size
+        with self.lock:
+            entry = self.entries.get(fileName)
+            if entry and entry[0] == signature:
+                return entry[1]
+        self.diag.info("Indexing " + fileName)
+        trigrams = getFileTrigrams(fileName)
+        if time.time() - statInfo.st_mtime > self.minimumAge:
+            with self.lock:
+                self.entries[fileName] = signature, trigrams
+                self.changed = True
+        return trigrams
+
+    def mightContain(self, fileName, trigramSets):
+        """ False if the file can't contain any of the texts with the given trigrams """
+        try:
+            fileTrigrams = self.getTrigrams(fileName)
+        except OSError:
+            return True
+        if fileTrigrams is None:
+            return True  # Too big to index
+        return any((trigrams.issubset(fileTrigrams) for trigrams in trigramSets))
@@ -9,6 +9,7 @@ from texttestlib import plugins
 from configparser import ConfigParser, NoOptionError
 from copy import copy
 from collections import OrderedDict
+from threading import Lock
 
 plugins.addCategory("bug", "known bugs", "had known bugs")
 plugins.addCategory("badPredict", "internal errors", "had internal errors")
@@ -288,6 +289,11 @@ class ParseMethod:
 
 
 class BugMap(OrderedDict):
+    # Parsed files, shared by all the tests in the process. Each is parsed again if it changes.
+    # The parsers are only read from, so it doesn't matter which threads use them
+    parserCache = {}
+    parserCacheLock = Lock()
+
     def checkUnchanged(self):
         for bugData in list(self.values()):
             if bugData.checkUnchanged:
@@ -295,10 +301,26 @@ class BugMap(OrderedDict):
         return False
 
     def readFromFile(self, fileName):
-        parser = self.makeParser(fileName)
+        parser = self.getCachedParser(fileName)
         if parser:
             self.readFromParser(parser)
 
+    @classmethod
+    def getCachedParser(cls, fileName):
+        try:
+            statInfo = os.stat(fileName)
+        except OSError:
+            return cls.makeParser(fileName)
+        signature = statInfo.st_mtime_ns, statInfo.st_size
+        with cls.parserCacheLock:
+            cached = cls.parserCache.get(fileName)
+            if cached and cached[0] == signature:
+                return cached[1]
+        parser = cls.makeParser(fileName)
+        with cls.parserCacheLock:
+            cls.parserCache[fileName] = signature, parser
+        return parser
+
     def readFromFileObject(self, f):
         parser = self.makeParserFromFileObject(f)
         if parser:
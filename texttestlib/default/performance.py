@@ -137,6 +137,8 @@ class PerformanceConfigSettings:
 
 
 class PerformanceFileComparison(FileComparison):
+    stateFields = ("perfComparison",)
+
     def __init__(self, *args, **kw):
         self.perfComparison = None
         FileComparison.__init__(self, *args, **kw)
@@ -205,6 +207,8 @@ class PerformanceFileComparison(FileComparison):
 
 
 class PerformanceComparison:
+    stateFields = ("oldPerformance", "newPerformance", "percentageChange", "descriptor")
+
     def __init__(self, oldPerf, newPerf, settings):
         self.oldPerformance = oldPerf
         self.newPerformance = newPerf
@@ -6,8 +6,11 @@ import logging
 import time
 import datetime
 from texttestlib import plugins
-from glob import glob
 from itertools import groupby
+from io import BytesIO
+from collections import deque
+from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 
 # Trawl around for a suitable dir to reconnect to if we haven't been told one
 # A tangle of side-effects: we find the run directory when asked for the extra versions,
@@ -117,10 +120,16 @@ class ReconnectConfig:
         return "." + fullVersion
 
     def isRunDirectoryFor(self, app, d):
-        for permutation in self.all_perms(app.versions):
-            appDirRoot = os.path.join(d, app.name + self.versionSuffix(permutation))
-            if os.path.isdir(appDirRoot) or len(glob(appDirRoot + ".*")) > 0:
-                return True
+        # List the directory once and match in memory, rather than asking the file system about every permutation
+        try:
+            entries = list(os.scandir(d))
+        except OSError:
+            return False
+        appDirNames = [app.name + self.versionSuffix(permutation) for permutation in self.all_perms(app.versions)]
+        for entry in entries:
+            for appDirName in appDirNames:
+                if (entry.name == appDirName and entry.is_dir()) or entry.name.startswith(appDirName + "."):
+                    return True
         return False
 
     def getVersionListsTopDir(self, fileName):
@@ -256,11 +265,53 @@ class ReconnectFilter(plugins.TextFilter):
         return os.path.exists(os.path.join(self.rootDir, suite.getRelPath()))
 
 
+class ResultPrefetcher:
+    """ Reads tests' results in the order the tests will be reached, keeping at most maxPrefetched of them
+    read or being read ahead of being used """
+
+    def __init__(self, readMethod, threads, maxPrefetched):
+        self.readMethod = readMethod
+        self.maxPrefetched = maxPrefetched
+        self.executor = ThreadPoolExecutor(threads)
+        self.waiting = deque()
+        self.futures = {}
+        self.lock = Lock()
+
+    def addLocations(self, locations):
+        with self.lock:
+            self.waiting.extend(locations)
+            self.submitWaiting()
+
+    def submitWaiting(self):
+        while self.waiting and len(self.futures) < self.maxPrefetched:
+            location = self.waiting.popleft()
+            self.futures[location] = self.executor.submit(self.readMethod, location)
+
+    def read(self, location):
+        with self.lock:
+            future = self.futures.pop(location, None)
+            self.submitWaiting()
+        return future.result() if future else self.readMethod(location)
+
+    def shutdown(self):
+        with self.lock:
+            self.waiting.clear()
+            self.futures.clear()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+
 class ReconnectTest(plugins.Action):
+    # Reading the results of a large run, probably on a network disk, is mostly waiting for the file system
+    loadThreads = 8
+    maxPrefetched = 100
+    # Shared with the copies of the action made for other workers (-j), by reconnection directory
+    prefetchers = {}
+
     def __init__(self, rootDirToCopy, fullRecalculate):
         self.rootDirToCopy = rootDirToCopy
         self.fullRecalculate = fullRecalculate
         self.diag = logging.getLogger("Reconnection")
+        self.prefetcher = None
 
     def __repr__(self):
         return "Reconnecting to"
@@ -274,50 +325,83 @@ class ReconnectTest(plugins.Action):
     def getReconnectState(self, test):
         reconnLocation = os.path.join(self.rootDirToCopy, test.getRelPath())
         self.diag.info("Reconnecting to test at " + reconnLocation)
-        if os.path.isdir(reconnLocation):
-            return self.getReconnectStateFrom(test, reconnLocation)
+        if self.prefetcher:
+            locationInfo = self.prefetcher.read(reconnLocation)
+        else:
+            locationInfo = self.readLocation(reconnLocation)
+        if locationInfo is not None:
+            return self.getReconnectStateFrom(test, reconnLocation, locationInfo=locationInfo)
         else:
             return plugins.Unrunnable(briefText="no results",
                                       freeText="No file found to load results from under " + reconnLocation)
 
+    @staticmethod
+    def readLocation(location):
+        # Returns the files in the test's directory and the contents of its state file, or None if there is no directory
+        try:
+            fileNames = [entry.name for entry in os.scandir(location) if entry.is_file()]
+        except OSError:
+            return
+        stateFile = os.path.join(location, "framework_tmp", "teststate")
+        try:
+            with open(stateFile, "rb") as f:
+                return fileNames, f.read()
+        except OSError:
+            return fileNames, None
+
+    def prefetchTests(self, suite):
+        # Start reading the tests' results ahead of time, they are then picked up as the tests are reached
+        if self.prefetcher is None:
+            self.prefetcher = ResultPrefetcher(self.readLocation, self.loadThreads, self.maxPrefetched)
+            self.prefetchers[self.rootDirToCopy] = self.prefetcher
+        locations = [os.path.join(self.rootDirToCopy, test.getRelPath()) for test in suite.testCaseList()]
+        self.prefetcher.addLocations(locations)
+
     def getStateText(self, state):
         if state:
             return " (state " + state.category + ")"
         else:
             return " (recomputing)"
 
-    def getReconnectStateFrom(self, test, location, copyEvenIfLoadFails=True):
+    def getReconnectStateFrom(self, test, location, copyEvenIfLoadFails=True, locationInfo=None):
         stateToUse = None
-        stateFile = os.path.join(location, "framework_tmp", "teststate")
-        if os.path.isfile(stateFile):
+        fileNames, stateData = locationInfo or self.readLocation(location) or ([], None)
+        if stateData is not None:
             newTmpPath = os.path.dirname(self.rootDirToCopy)
-            loaded, newState = test.getNewState(open(stateFile, "rb"), updatePaths=True, newTmpPath=newTmpPath)
-            self.diag.info("Loaded state file at " + stateFile + " - " + repr(loaded))
+            loaded, newState = test.getNewState(BytesIO(stateData), updatePaths=True, newTmpPath=newTmpPath)
+            self.diag.info("Loaded state file under " + location + " - " + repr(loaded))
             if loaded and self.modifyState(test, newState):  # if we can't read it, recompute it
                 stateToUse = newState
 
         if (copyEvenIfLoadFails or stateToUse) and (self.fullRecalculate or not stateToUse):
-            self.copyFiles(test, location)
+            self.copyFiles(test, location, fileNames)
 
         return stateToUse
 
-    def copyFiles(self, test, reconnLocation):
+    def copyFiles(self, test, reconnLocation, fileNames=None):
         test.makeWriteDirectory()
         tmpDir = test.getDirectory(temporary=1)
         plugins.ensureDirectoryExists(tmpDir)
         self.diag.info("Copying files from " + reconnLocation + " to " + tmpDir)
-        for file in os.listdir(reconnLocation):
-            fullPath = os.path.join(reconnLocation, file)
-            if os.path.isfile(fullPath):
-                targetPath = os.path.join(tmpDir, os.path.basename(fullPath))
-                try:
-                    shutil.copyfile(fullPath, targetPath)
-                except EnvironmentError as e:
-                    # File could not be copied, may not have been readable
-                    # Write the exception to it instead
-                    targetFile = open(targetPath, "w")
-                    targetFile.write("Failed to copy file - exception info follows :\n" + str(e) + "\n")
-                    targetFile.close()
+        if fileNames is None:
+            fileNames = [f for f in os.listdir(reconnLocation) if os.path.isfile(os.path.join(reconnLocation, f))]
+        paths = [(os.path.join(reconnLocation, f), os.path.join(tmpDir, f)) for f in fileNames]
+        if self.prefetcher and len(paths) > 1:
+            list(self.prefetcher.executor.map(self.copyFile, *zip(*paths)))
+        else:
+            for fullPath, targetPath in paths:
+                self.copyFile(fullPath, targetPath)
+
+    @staticmethod
+    def copyFile(fullPath, targetPath):
+        try:
+            shutil.copyfile(fullPath, targetPath)
+        except EnvironmentError as e:
+            # File could not be copied, may not have been readable
+            # Write the exception to it instead
+            targetFile = open(targetPath, "w")
+            targetFile.write("Failed to copy file - exception info follows :\n" + str(e) + "\n")
+            targetFile.close()
 
     def modifyState(self, test, newState):
         if self.fullRecalculate:
@@ -338,3 +422,19 @@ class ReconnectTest(plugins.Action):
 
     def setUpSuite(self, suite):
         self.describe(suite)
+        if suite.parent is None:
+            self.prefetchTests(suite)
+
+    def setUpApplicationInCopy(self, app):
+        pass
+
+    def setUpSuiteInCopy(self, suite):
+        # Share the results the first copy is reading ahead
+        if suite.parent is None:
+            self.prefetcher = self.prefetchers.get(self.rootDirToCopy)
+
+    @classmethod
+    def finalise(cls):
+        for prefetcher in cls.prefetchers.values():
+            prefetcher.shutdown()
+        cls.prefetchers.clear()
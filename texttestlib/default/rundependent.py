@@ -2,12 +2,15 @@
 
 
 import os
+import re
 import logging
 import shutil
+import hashlib
 from texttestlib.default import fpdiff
-from texttestlib import plugins
+from texttestlib import plugins, texttest_version
 from optparse import OptionParser
 from io import StringIO
+from tempfile import SpooledTemporaryFile
 
 
 class Filtering(plugins.TestState):
@@ -17,6 +20,57 @@ class Filtering(plugins.TestState):
 # Generic base class for filtering standard and temporary files
 
 
+def filterStages(filters, inFile, fileName, finalFile=None, maxMemorySize=None):
+    # Each filter feeds the next one in memory, only the last one writes to finalFile if given.
+    # With maxMemorySize, anything bigger than that is passed on in a temporary file instead
+    diag = logging.getLogger("Filter Actions")
+    for index, fileFilter in enumerate(filters):
+        diag.info("Applying " + fileFilter.__class__.__name__ + " to " + fileName)
+        isLast = index == len(filters) - 1
+        if isLast and finalFile is not None:
+            outFile = finalFile
+        elif maxMemorySize is not None:
+            outFile = SpooledTemporaryFile(maxMemorySize, mode="w+", encoding="utf-8", errors="ignore")
+        else:
+            outFile = StringIO()
+        try:
+            fileFilter.filterFile(inFile, outFile)
+        finally:
+            inFile.close()
+        if outFile is not finalFile:
+            outFile.seek(0)
+        yield fileFilter, outFile
+        inFile = outFile
+
+
+def writeFilteredFile(filters, fileName, newFileName, keepStageFiles, largeFileSize=None):
+    # May be run in a separate process, so only uses what it is given
+    diag = logging.getLogger("Filter Actions")
+    # Output from large files is kept in temporary files between the filters, anything else in memory
+    maxMemorySize = largeFileSize if largeFileSize is not None and os.path.getsize(fileName) >= largeFileSize else None
+    writeFileName = newFileName + "." + filters[-1].postfix
+    diag.info("Filtering to make\n" + writeFileName + " from\n " + fileName)
+    if os.path.isfile(writeFileName):
+        diag.info("Removing previous file at " + writeFileName)
+        os.remove(writeFileName)
+    writeFile = plugins.openForWrite(writeFileName)
+    try:
+        inFile = open(fileName, errors="ignore")
+        for fileFilter, outFile in filterStages(filters, inFile, fileName, writeFile, maxMemorySize):
+            # The .normal file is always needed when something follows it: saving filtered files
+            # and the GUI's content-filtered view both use it to leave out the later stages
+            keepStageFile = keepStageFiles or fileFilter.postfix == RunDependentTextFilter.postfix
+            if keepStageFile and outFile is not writeFile:
+                stageFileName = newFileName + "." + fileFilter.postfix
+                diag.info("Writing intermediate filtering result to " + stageFileName)
+                with plugins.openForWrite(stageFileName) as f:
+                    shutil.copyfileobj(outFile, f)
+                outFile.seek(0)
+    finally:
+        writeFile.close()
+    shutil.move(writeFileName, newFileName)
+
+
 class FilterAction(plugins.Action):
     def __init__(self, useFilteringStates=False):
         self.diag = logging.getLogger("Filter Actions")
@@ -26,11 +80,20 @@ class FilterAction(plugins.Action):
         if self.useFilteringStates:
             self.changeToFilteringState(test)
 
+        parallelFilterings = []
         for fileName, postfix in self.filesToFilter(test):
             self.diag.info("Considering for filtering : " + fileName)
             stem = self.getStem(fileName)
             newFileName = test.makeTmpFileName(stem + "." + test.app.name + postfix, forFramework=1)
-            self.performAllFilterings(test, stem, fileName, newFileName)
+            if self.canFilterInParallel(test, fileName):
+                parallelFilterings.append((stem, fileName, newFileName))
+            else:
+                self.performAllFilterings(test, stem, fileName, newFileName)
+        if len(parallelFilterings) > 1:
+            self.performParallelFilterings(test, parallelFilterings)
+        else:
+            for filtering in parallelFilterings:
+                self.performAllFilterings(test, *filtering)
 
     def getStem(self, fileName):
         return os.path.basename(fileName).split(".")[0]
@@ -38,23 +101,67 @@ class FilterAction(plugins.Action):
     def changeToFilteringState(self, *args):  # pragma: no cover - documentation only
         pass
 
+    def canFilterInParallel(self, test, fileName):
+        if test.getConfigValue("file_comparison_processes") > 0:
+            minSize = plugins.parseBytes(test.getConfigValue("file_comparison_parallel_size"))
+            return os.path.isfile(fileName) and os.path.getsize(fileName) >= minSize
+
     def performAllFilterings(self, test, stem, fileName, newFileName):
-        currFileName = fileName
         filters = self.makeAllFilters(test, stem, test.app)
-        for fileFilter in filters:
-            writeFileName = newFileName + "." + fileFilter.postfix
-            self.diag.info("Applying " + fileFilter.__class__.__name__ +
-                           " to make\n" + writeFileName + " from\n " + currFileName)
-            if os.path.isfile(writeFileName):
-                self.diag.info("Removing previous file at " + writeFileName)
-                os.remove(writeFileName)
-            currFile = open(currFileName, errors="ignore")
-            writeFile = plugins.openForWrite(writeFileName)
-            fileFilter.filterFile(currFile, writeFile)
-            writeFile.close()
-            currFileName = writeFileName
-        if len(filters) > 0 and currFileName != newFileName:
-            shutil.move(currFileName, newFileName)
+        if len(filters) > 0:
+            self.writeFilteredFile(test, filters, fileName, newFileName)
+
+    def performParallelFilterings(self, test, filterings):
+        pool = plugins.getProcessPool(test.getConfigValue("file_comparison_processes"))
+        keepStageFiles = test.getConfigValue("keep_intermediate_filter_files") == "true"
+        largeFileSize = self.getLargeFileSize(test)
+        jobs = []
+        for stem, fileName, newFileName in filterings:
+            filters = self.makeAllFilters(test, stem, test.app)
+            if len(filters) > 0:
+                cacheEntry = self.getCacheEntry(test, filters, fileName)
+                if not self.fetchFromCache(cacheEntry, fileName, newFileName):
+                    self.diag.info("Filtering " + fileName + " in a separate process")
+                    future = pool.submit(writeFilteredFile, filters, fileName, newFileName, keepStageFiles, largeFileSize)
+                    jobs.append((future, filters, fileName, newFileName, cacheEntry))
+        # Wait in the order we started, so everything happens as if we had done them one at a time
+        for future, filters, fileName, newFileName, cacheEntry in jobs:
+            try:
+                future.result()
+            except Exception as e:
+                # Whatever went wrong should happen again here, and be reported as usual if it does
+                self.diag.info("Filtering " + fileName + " in a separate process failed, trying again : " + str(e))
+                writeFilteredFile(filters, fileName, newFileName, keepStageFiles, largeFileSize)
+            self.storeInCache(cacheEntry, newFileName)
+
+    def writeFilteredFile(self, test, filters, fileName, newFileName):
+        cacheEntry = self.getCacheEntry(test, filters, fileName)
+        if not self.fetchFromCache(cacheEntry, fileName, newFileName):
+            keepStageFiles = test.getConfigValue("keep_intermediate_filter_files") == "true"
+            writeFilteredFile(filters, fileName, newFileName, keepStageFiles, self.getLargeFileSize(test))
+            self.storeInCache(cacheEntry, newFileName)
+
+    def getLargeFileSize(self, test):
+        return int(plugins.parseBytes(test.getConfigValue("large_file_size")))
+
+    def getCacheEntry(self, test, filters, fileName):
+        pass
+
+    def fetchFromCache(self, cacheEntry, fileName, newFileName):
+        if cacheEntry:
+            cache, key = cacheEntry
+            if cache.fetch(key, newFileName):
+                self.diag.info("Using cached filtered file for " + fileName)
+                return True
+        return False
+
+    def storeInCache(self, cacheEntry, newFileName):
+        if cacheEntry:
+            cache, key = cacheEntry
+            cache.store(key, newFileName)
+
+    def filterStages(self, filters, inFile, fileName, finalFile=None):
+        return filterStages(filters, inFile, fileName, finalFile)
 
     def getAllFilters(self, test, fileName, app):
         stem = self.getStem(fileName)
@@ -68,13 +175,8 @@ class FilterAction(plugins.Action):
                 return inFile.read()
             finally:
                 inFile.close()
-        for fileFilter in filters:
-            self.diag.info("Applying " + fileFilter.__class__.__name__ + " to " + fileName)
-            outFile = StringIO()
-            fileFilter.filterFile(inFile, outFile)
-            inFile.close()
-            inFile = outFile
-            inFile.seek(0)
+        for _, outFile in self.filterStages(filters, inFile, fileName):
+            pass
         value = outFile.getvalue()
         outFile.close()
         return value
@@ -112,6 +214,12 @@ class FilterOriginal(FilterAction):
         resultFiles, defFiles = test.listApprovedFiles(allVersions=False, defFileCategory="regenerate")
         return self.constantPostfix(resultFiles + defFiles, "origcmp")
 
+    def getCacheEntry(self, test, filters, fileName):
+        # Approved files rarely change, so we can often reuse what we filtered last time
+        cache = FilterCache.forApp(test.app)
+        if cache is not None:
+            return cache, cache.makeKey(fileName, filters)
+
     def changeToFilteringState(self, test):
         # Notifications of current status are only useful when doing normal filtering in the GUI
         execMachines = test.state.executionHosts
@@ -178,6 +286,80 @@ class FilterResultRecompute(FilterOnTempFile):
         return result
 
 
+class FilterCache:
+    """ Filtered approved files, kept between runs. Entries are named by a hash of the approved file's contents,
+    the filters applied and the TextTest version, so any change to these simply means a different entry is used. """
+    def __init__(self, cacheDir):
+        self.cacheDir = cacheDir
+        self.diag = logging.getLogger("Filter Actions")
+
+    @classmethod
+    def getDirectory(cls, app):
+        location = app.getConfigValue("filter_cache_location")
+        if location:
+            return os.path.join(os.path.expanduser(location), app.name)
+
+    @classmethod
+    def forApp(cls, app):
+        cacheDir = cls.getDirectory(app)
+        if cacheDir:
+            return cls(cacheDir)
+
+    @classmethod
+    def clear(cls, app):
+        cacheDir = cls.getDirectory(app)
+        if cacheDir and os.path.isdir(cacheDir):
+            plugins.log.info("Removing cached filtered files for " + app.fullName() + " at " + cacheDir)
+            plugins.rmtree(cacheDir)
+
+    def makeKey(self, fileName, filters):
+        digest = hashlib.sha1(texttest_version.version.encode())
+        for fileFilter in filters:
+            digest.update(fileFilter.getFingerprint().encode())
+        with open(fileName, "rb") as f:
+            for data in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(data)
+        return digest.hexdigest()
+
+    def getPath(self, key):
+        return os.path.join(self.cacheDir, key[:2], key)
+
+    def fetch(self, key, newFileName):
+        path = self.getPath(key)
+        try:
+            shutil.copyfile(path, newFileName)
+            self.fetchStageFile(path, newFileName)
+            return True
+        except OSError:
+            return False
+
+    def fetchStageFile(self, path, newFileName):
+        # The .normal stage is kept alongside the entry, as writeFilteredFile leaves it next to the filtered file
+        stageFileName = newFileName + "." + RunDependentTextFilter.postfix
+        if os.path.isfile(path + "." + RunDependentTextFilter.postfix):
+            shutil.copyfile(path + "." + RunDependentTextFilter.postfix, stageFileName)
+        elif os.path.isfile(stageFileName):
+            os.remove(stageFileName)
+
+    def store(self, key, fileName):
+        path = self.getPath(key)
+        try:
+            plugins.ensureDirExistsForFile(path)
+            stageFileName = fileName + "." + RunDependentTextFilter.postfix
+            # Store the stage file first, so an entry is never found without it
+            if os.path.isfile(stageFileName):
+                self.storeFile(stageFileName, path + "." + RunDependentTextFilter.postfix)
+            self.storeFile(fileName, path)
+        except OSError as e:
+            self.diag.info("Failed to store filtered file in cache : " + str(e))
+
+    def storeFile(self, fileName, path):
+        tmpPath = path + "." + str(os.getpid())
+        shutil.copyfile(fileName, tmpPath)
+        # Other TextTest runs may be using the same cache
+        os.replace(tmpPath, path)
+
+
 class FloatingPointFilter:
     postfix = "fpdiff"
 
@@ -188,9 +370,8 @@ class FloatingPointFilter:
         self.split = split
 
     def filterFile(self, inFile, writeFile):
-        fromlines = open(self.origFileName, errors="ignore").readlines()
-        tolines = inFile.readlines()
-        fpdiff.fpfilter(fromlines, tolines, writeFile, self.tolerance, self.relative, split=self.split)
+        with open(self.origFileName, errors="ignore") as fromFile:
+            fpdiff.fpfilter(fromFile, inFile, writeFile, self.tolerance, self.relative, split=self.split)
 
 
 class RunDependentTextFilter(plugins.Observable):
@@ -200,7 +381,13 @@ class RunDependentTextFilter(plugins.Observable):
     def __init__(self, filterTexts, testId=""):
         plugins.Observable.__init__(self)
         self.diag = logging.getLogger("Run Dependent Text")
+        self.testId = testId
         self.lineFilters = [LineFilter(text, testId, self.diag) for text in filterTexts]
+        self.compiledTriggers = CompiledTriggerSet(self.lineFilters)
+        self.hasMultiLineFilters = any(lineFilter.isMultiLine() for lineFilter in self.lineFilters)
+
+    def getFingerprint(self):
+        return self.__class__.__name__ + repr((self.testId, [f.originalText for f in self.lineFilters]))
 
     def findRelevantFilters(self, file):
         relevantFilters, sectionFilters = [], []
@@ -275,16 +462,24 @@ class RunDependentTextFilter(plugins.Observable):
         linesToRemove = 0
         filtersToRemove = []
         alreadyFilteredAway = False
+        # Filters that are idle and whose triggers can't match this line need not be asked at all
+        screenedOut = self.compiledTriggers.getScreenedOut(line)
+        if screenedOut and self.compiledTriggers.screensAll and not self.anyActive(lineFilters):
+            return None, line, 0
         for lineFilter, lastRelevantLine in lineFilters:
-            changed, currFilteredLine, removeCount = lineFilter.applyTo(line, lineNumber, alreadyFilteredAway)
             if lastRelevantLine is not None and lineNumber >= lastRelevantLine:
                 filtersToRemove.append((lineFilter, lastRelevantLine))
+            if lineFilter in screenedOut and not lineFilter.autoRemove:
+                continue
 
+            changed, currFilteredLine, removeCount = lineFilter.applyTo(line, lineNumber, alreadyFilteredAway)
             if changed:
                 appliedLineFilter = lineFilter
                 linesToRemove = max(removeCount, linesToRemove)
                 if currFilteredLine and filteredLine:
                     line = currFilteredLine
+                    # Later filters see the rewritten line, which their triggers may now match
+                    screenedOut = self.compiledTriggers.getScreenedOut(line)
                 if filteredLine:
                     filteredLine = currFilteredLine
                 if currFilteredLine is None:
@@ -294,6 +489,66 @@ class RunDependentTextFilter(plugins.Observable):
 
         return appliedLineFilter, filteredLine, linesToRemove
 
+    def anyActive(self, lineFilters):
+        # Only multi-line filters carry state from one line to the next
+        if self.hasMultiLineFilters:
+            for lineFilter, lastRelevantLine in lineFilters:
+                if lineFilter.autoRemove or lastRelevantLine is not None:
+                    return True
+        return False
+
+
+class CompiledTriggerSet:
+    """Screens each line against the triggers of all the given LineFilters at once.
+    Plain regular expressions are merged into a single alternation and literal texts are checked with
+    substring search, so that a line which no trigger can match is rejected in one step. Triggers that
+    depend on line numbers, or regular expressions that can't safely be merged, are never screened
+    and are always evaluated by their own filter."""
+    # Back-references, named groups and inline flags would change meaning inside a bigger expression
+    unmergeableRegex = re.compile(r"\\[1-9]|\(\?P[=<]|\(\?<|\(\?\(|\(\?[aiLmsux]")
+
+    def __init__(self, lineFilters):
+        self.screened = set()
+        self.literals = []
+        regexTexts = []
+        for lineFilter in lineFilters:
+            trigger = lineFilter.trigger
+            if not isinstance(trigger, plugins.TextTrigger):
+                continue
+            if trigger.regex is None:
+                self.literals.append(trigger.text)
+            elif self.canMerge(trigger):
+                regexTexts.append(trigger.text)
+            else:
+                continue
+            self.screened.add(lineFilter)
+        self.regex = self.compileAlternation(regexTexts)
+        self.screensAll = len(self.screened) == len(lineFilters)
+
+    def canMerge(self, trigger):
+        return trigger.regex.flags == re.UNICODE and self.unmergeableRegex.search(trigger.text) is None
+
+    def compileAlternation(self, regexTexts):
+        if len(regexTexts) == 0:
+            return
+        try:
+            return re.compile("|".join("(?:" + text + ")" for text in regexTexts))
+        except re.error:
+            # Shouldn't happen, but better to screen nothing than to change behaviour
+            self.screened = set(f for f in self.screened if f.trigger.regex is None)
+
+    def mightMatch(self, line):
+        for literal in self.literals:
+            if literal in line:
+                return True
+        return self.regex is not None and self.regex.search(line) is not None
+
+    def getScreenedOut(self, line):
+        if not self.screened or self.mightMatch(line):
+            return ()
+        else:
+            return self.screened
+
 
 class UnorderedTextFilter(RunDependentTextFilter):
     configKey = "unordered_text"
@@ -33,6 +33,8 @@ class Running(plugins.TestState):
 
 
 class Killed(plugins.TestState):
+    stateFields = ("prevState", "failedPrediction")
+
     def __init__(self, briefText, freeText, prevState):
         plugins.TestState.__init__(self, "killed", briefText=briefText, freeText=freeText,
                                    started=1, completed=1, executionHosts=prevState.executionHosts)
@@ -427,3 +429,6 @@ class RunTest(plugins.Action):
 
     def setUpSuite(self, suite):
         self.describe(suite)
+
+    def setUpSuiteInCopy(self, suite):
+        pass
@@ -32,6 +32,9 @@ class MakeWriteDirectory(plugins.Action):
     def setUpApplication(self, app):
         app.makeWriteDirectory()
 
+    def setUpApplicationInCopy(self, app):
+        pass
+
 
 class PrepareWriteDirectory(plugins.Action):
     storytextDirsCopied = set()
@@ -345,6 +348,9 @@ class PrepareWriteDirectory(plugins.Action):
         if suite.parent is None:
             self.tryCopySUTRemotely(suite)
 
+    def setUpSuiteInCopy(self, suite):
+        pass
+
     def isCopy(self, app):
         return any(("copy_" in v for v in app.versions))
 
@@ -778,8 +784,6 @@ class CollateFiles(plugins.Action):
         return False
 
     def glob(self, test, sourcePattern):
-        # Test name may contain glob meta-characters, and there is no way to quote them (see comment in fnmatch.py)
-        # So we can't just form an absolute path and glob that
         localTestDir = test.getDirectory(temporary=1, local=1)
         localFiles = self.globDir(localTestDir, sourcePattern)
         if not localFiles:
@@ -791,11 +795,9 @@ class CollateFiles(plugins.Action):
         return localTestDir, localFiles
 
     def globDir(self, testDir, sourcePattern):
-        origCwd = os.getcwd()
-        os.chdir(testDir)
-        result = glob.glob(sourcePattern)
-        os.chdir(origCwd)
-        return [os.path.join(testDir, f) for f in result]
+        # Test name may contain glob meta-characters, so quote them. Don't change directory to glob there,
+        # other tests may be collating their files in other threads
+        return glob.glob(os.path.join(glob.escape(testDir), sourcePattern))
 
     def findPaths(self, test, sourcePattern):
         self.diag.info("Looking for pattern " + sourcePattern + " for " + repr(test))
@@ -0,0 +1,234 @@
+import os
+import time
+from collections import deque
+from itertools import islice, zip_longest
+
+# Text diff programs whose output we can produce ourselves, without starting a process for every file.
+# Anything else configured as 'text_diff_program' is still run externally.
+# Where a change could be shown in more than one place, e.g. adding a line next to an identical one,
+# GNU diff's heuristics may choose a different place than we do. Otherwise the output is the same.
+builtinFormats = {"diff": "normal", "diff -u": "unified", "diff --unified": "unified"}
+unifiedContext = 3
+
+
+def hasBuiltinFormat(diffTool):
+    return " ".join(diffTool.split()) in builtinFormats
+
+
+def _shortestEdit(a, b):
+    # Myers' O(ND) algorithm. Returns the edit script as a list of (x, y) points
+    n, m = len(a), len(b)
+    offset = n + m + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+    for d in range(n + m + 1):
+        trace.append(v[offset - d:offset + d + 1])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                return _backtrack(trace, n, m)
+    return []
+
+
+def _backtrack(trace, x, y):
+    path = [(x, y)]
+    for d in range(len(trace) - 1, 0, -1):
+        v = trace[d]
+        k = x - y
+        # v holds the entries from -d to d, v[0] corresponds to k = -d
+        if k == -d or (k != d and v[k - 1 + d] < v[k + 1 + d]):
+            prevK = k + 1
+        else:
+            prevK = k - 1
+        prevX = v[prevK + d]
+        prevY = prevX - prevK
+        while x > prevX and y > prevY:
+            x -= 1
+            y -= 1
+            path.append((x, y))
+        x, y = prevX, prevY
+        path.append((x, y))
+    while x > 0 and y > 0:
+        x -= 1
+        y -= 1
+        path.append((x, y))
+    path.reverse()
+    return path
+
+
+def _firstHunk(a, b, complete):
+    # Find the first changed region, which must be followed by a common line unless we have all the text
+    path = _shortestEdit(a, b)
+    endX, endY = 0, 0
+    for (x1, y1), (x2, y2) in zip(path, path[1:]):
+        if x2 - x1 == 1 and y2 - y1 == 1:
+            return 0, endX, 0, endY
+        endX, endY = x2, y2
+    if complete:
+        return 0, endX, 0, endY
+
+
+def _iterHunks(a, b, window, maxWindow):
+    i, j = 0, 0
+    n, m = len(a), len(b)
+    size = window
+    while True:
+        while i < n and j < m and a[i] == b[j]:
+            i += 1
+            j += 1
+        if i == n and j == m:
+            return
+        endA, endB = min(n, i + size), min(m, j + size)
+        hunk = _firstHunk(a[i:endA], b[j:endB], endA == n and endB == m)
+        if hunk:
+            i1, i2, j1, j2 = hunk
+            yield i + i1, i + i2, j + j1, j + j2
+            i, j = i + i2, j + j2
+            size = window
+        elif size < maxWindow:
+            size *= 2
+        else:
+            # Nothing in common for a long way: not worth searching further for a preview
+            yield i, n, j, m
+            return
+
+
+def _outputLines(text):
+    # diff's output is read with universal newlines, which turns "\r\n" and a lone "\r" into "\n"
+    return text.replace("\r\n", "\n").replace("\r", "\n").splitlines(True)
+
+
+def _markedLines(prefix, lines):
+    for line in lines:
+        if line.endswith("\n"):
+            yield from _outputLines(prefix + line)
+        else:
+            yield from _outputLines(prefix + line + "\n")
+            yield "\\ No newline at end of file\n"
+
+
+def _rangeText(start, end, offset=0):
+    if end - start == 1:
+        return str(offset + start + 1)
+    else:
+        return str(offset + start + 1) + "," + str(offset + end)
+
+
+def _normalFormat(a, b, hunks, offset=0):
+    # offset is the number of lines before those in a and b, which are the same in both files
+    for i1, i2, j1, j2 in hunks:
+        if i1 == i2:
+            yield str(offset + i1) + "a" + _rangeText(j1, j2, offset) + "\n"
+        elif j1 == j2:
+            yield _rangeText(i1, i2, offset) + "d" + str(offset + j1) + "\n"
+        else:
+            yield _rangeText(i1, i2, offset) + "c" + _rangeText(j1, j2, offset) + "\n"
+        yield from _markedLines("< ", a[i1:i2])
+        if i1 != i2 and j1 != j2:
+            yield "---\n"
+        yield from _markedLines("> ", b[j1:j2])
+
+
+def _unifiedRange(start, end, offset=0):
+    length = end - start
+    if length == 1:
+        return str(offset + start + 1)
+    firstLine = start + 1 if length else start
+    return str(offset + firstLine) + "," + str(length)
+
+
+def _unifiedHeader(marker, fileName):
+    modTime, nanoseconds = divmod(os.stat(fileName).st_mtime_ns, 1000000000)
+    localTime = time.localtime(modTime)
+    timeText = time.strftime("%Y-%m-%d %H:%M:%S", localTime) + "." + str(nanoseconds).zfill(9) + \
+        " " + time.strftime("%z", localTime)
+    return marker + " " + fileName + "\t" + timeText + "\n"
+
+
+def _groupHunks(hunks):
+    group = []
+    for hunk in hunks:
+        if group and hunk[0] - group[-1][1] > 2 * unifiedContext:
+            yield group
+            group = []
+        group.append(hunk)
+    if group:
+        yield group
+
+
+def _unifiedFormat(a, b, hunks, fromFileName, toFileName, offset=0):
+    headerWritten = False
+    for group in _groupHunks(hunks):
+        if not headerWritten:
+            yield _unifiedHeader("---", fromFileName)
+            yield _unifiedHeader("+++", toFileName)
+            headerWritten = True
+        startA = max(group[0][0] - unifiedContext, 0)
+        startB = max(group[0][2] - unifiedContext, 0)
+        endA = min(group[-1][1] + unifiedContext, len(a))
+        endB = min(group[-1][3] + unifiedContext, len(b))
+        yield "@@ -" + _unifiedRange(startA, endA, offset) + " +" + _unifiedRange(startB, endB, offset) + " @@\n"
+        prevA = startA
+        for i1, i2, j1, j2 in group:
+            yield from _markedLines(" ", a[prevA:i1])
+            yield from _markedLines("-", a[i1:i2])
+            yield from _markedLines("+", b[j1:j2])
+            prevA = i2
+        yield from _markedLines(" ", a[prevA:endA])
+
+
+def _readLines(fileName):
+    # As for diff, only "\n" ends a line
+    with open(fileName, errors="ignore", newline="\n") as f:
+        return f.readlines()
+
+
+def _readFromFirstDifference(fromFile, toFile, maxLinesAfter):
+    # Skip the lines that are the same without keeping them, apart from those needed as context
+    context = deque(maxlen=unifiedContext)
+    offset = 0
+    for fromLine, toLine in zip_longest(fromFile, toFile):
+        if fromLine != toLine:
+            break
+        context.append(fromLine)
+        offset += 1
+    else:
+        return offset, [], []
+    offset -= len(context)
+    a, b = list(context), list(context)
+    if fromLine is not None:
+        a.append(fromLine)
+        a += islice(fromFile, maxLinesAfter)
+    if toLine is not None:
+        b.append(toLine)
+        b += islice(toFile, maxLinesAfter)
+    return offset, a, b
+
+
+def diffFiles(fromFileName, toFileName, diffTool, maxLines, window=100, largeFiles=False):
+    """ Return the output 'diffTool' would give comparing the files, but no more than maxLines + 1 lines of it.
+    Differences are found incrementally, so only as much of the files is compared as is needed for the preview.
+    With largeFiles, only a limited number of lines from the first difference onwards are ever read, so a hunk
+    reaching the end of those is shown as ending there """
+    # A change longer than this would fill the preview on its own, so we don't need to know where it ends
+    maxWindow = max(window, 10 * maxLines)
+    if largeFiles:
+        with open(fromFileName, errors="ignore", newline="\n") as fromFile, \
+                open(toFileName, errors="ignore", newline="\n") as toFile:
+            offset, a, b = _readFromFirstDifference(fromFile, toFile, 10 * maxWindow)
+    else:
+        offset, a, b = 0, _readLines(fromFileName), _readLines(toFileName)
+    hunks = _iterHunks(a, b, window, maxWindow)
+    if builtinFormats[" ".join(diffTool.split())] == "unified":
+        lines = _unifiedFormat(a, b, hunks, fromFileName, toFileName, offset)
+    else:
+        lines = _normalFormat(a, b, hunks, offset)
+    return list(islice(lines, maxLines + 1))
@@ -123,6 +123,7 @@ class Activator(plugins.Responder, plugins.Observable):
         self.notify("StartRead")
         for suite in self.suites:
             try:
+                suite.app.startTestTreeRead()
                 self.readTestSuiteContents(suite)
                 self.diag.info("SUCCESS: Created test suite of size " + str(suite.size()))
 
@@ -133,6 +134,8 @@ class Activator(plugins.Responder, plugins.Observable):
                     rejectionInfo[suite.app] = "no tests matching the selection criteria found."
             except plugins.TextTestError as e:
                 rejectionInfo[suite.app] = str(e)
+            finally:
+                suite.app.finishTestTreeRead()
 
         self.notify("AllRead", goodSuites)
 
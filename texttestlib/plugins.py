@@ -11,16 +11,21 @@ import stat
 import shlex
 import fnmatch
 import subprocess
+import multiprocessing
 from collections import OrderedDict, deque
+from copy import deepcopy
+from itertools import islice
 from traceback import format_exception
 from threading import currentThread, RLock
 from queue import Queue, Empty
+from concurrent.futures import ProcessPoolExecutor
 from glob import glob
 from datetime import datetime
 from pickle import Unpickler
 from locale import getpreferredencoding
 import importlib.resources
 import sre_parse
+from . import stateformat
 
 
 class Callable:
@@ -250,6 +255,19 @@ def padNumbersWithZeroes(x):
     return re.sub("[0-9]+", padWithZeroes, x)
 
 
+processPools = {}
+processPoolLock = RLock()
+
+
+def getProcessPool(processes):
+    # Shared by everything that asks for the same number of processes, and kept for the whole run.
+    # Workers are started fresh rather than forked, as there are usually other threads running
+    with processPoolLock:
+        if processes not in processPools:
+            processPools[processes] = ProcessPoolExecutor(processes, mp_context=multiprocessing.get_context("spawn"))
+        return processPools[processes]
+
+
 # Parse the string as a byte expression.
 # Mb/mb/megabytes/mbytes
 def parseBytes(text):  # pragma: no cover
@@ -371,9 +389,17 @@ class TextTriggerGroup:
     def __init__(self, texts):
         self.texts = texts
         self.textTriggers = [TextTrigger(text) for text in self.texts]
+        # Only texts that really are patterns need searching for one by one.
+        # The rest are looked up directly, and otherwise searched for all together
+        self.regexTriggers = [trigger for trigger in self.textTriggers if trigger.regex]
+        plainTexts = [trigger.text for trigger in self.textTriggers if not trigger.regex]
+        self.plainTextSet = set(plainTexts)
+        self.plainTextRegex = re.compile("|".join(map(re.escape, plainTexts))) if plainTexts else None
 
     def stringContainsText(self, searchString):
-        for trigger in self.textTriggers:
+        if searchString in self.plainTextSet or (self.plainTextRegex and self.plainTextRegex.search(searchString)):
+            return True
+        for trigger in self.regexTriggers:
             if trigger.matches(searchString):
                 return True
         return False
@@ -408,8 +434,14 @@ class TestSelectionFilter(TextFilter):
 
     def __init__(self, *args):
         self.diag = logging.getLogger("TestSelectionFilter")
-        self.fullSuites = []
+        self.fullSuites = set()
         TextFilter.__init__(self, *args)
+        self.textSet = set(self.texts)
+        self.ancestorPaths = set()
+        for relPath in self.texts:
+            parts = relPath.split(os.sep)
+            for i in range(1, len(parts)):
+                self.ancestorPaths.add(os.sep.join(parts[:i]))
 
     def parseInput(self, filterText, app, suites):
         allEntries = TextFilter.parseInput(self, filterText, app, suites)
@@ -481,7 +513,7 @@ class TestSelectionFilter(TextFilter):
         return max(allApps, key=matchKey)
 
     def acceptsTestCase(self, test):
-        return test.getRelPath() in self.texts or self.hasFullSuiteAncestor(test.parent)
+        return test.getRelPath() in self.textSet or self.hasFullSuiteAncestor(test.parent)
 
     def hasFullSuiteAncestor(self, suite):
         return suite in self.fullSuites or (suite.parent and self.hasFullSuiteAncestor(suite.parent))
@@ -492,14 +524,12 @@ class TestSelectionFilter(TextFilter):
     def suiteInTexts(self, suite):
         if suite.parent is None:
             return True  # don't eliminate the root suite :)
-        for relPath in self.texts:
-            suitePath = suite.getRelPath()
-            if relPath == suitePath:
-                self.fullSuites.append(suite)
-                return True
-            elif relPath.startswith(suitePath + os.sep):
-                return True
-        return False
+        suitePath = suite.getRelPath()
+        if suitePath in self.textSet:
+            self.fullSuites.add(suite)
+            return True
+        else:
+            return suitePath in self.ancestorPaths
 
 
 # Generic action to be performed: all actions need to provide these methods
@@ -516,6 +546,16 @@ class Action:
     def tearDownSuite(self, suite):
         pass
 
+    # When tests run in parallel (-j), each worker has its own copy of the actions. Only the first copy to get
+    # there is set up as above, the others are set up with these. By default they're the same: actions whose set
+    # up does anything besides storing state in the action (logging, writing files, changing tests) should
+    # override them to leave that out
+    def setUpSuiteInCopy(self, suite):
+        self.setUpSuite(suite)
+
+    def setUpApplicationInCopy(self, app):
+        self.setUpApplication(app)
+
     def kill(self, test, sig):
         pass
 
@@ -608,6 +648,8 @@ class ThreadedNotificationHandler:
 
 class Observable:
     threadedNotificationHandler = ThreadedNotificationHandler()
+    # Set if several threads might notify directly at the same time
+    directNotificationLock = None
     obsDiag = None
     LAST_OBSERVER = "last observer"
 
@@ -636,7 +678,7 @@ class Observable:
             self.threadedNotificationHandler.transfer(self, *args, **kwargs)
         else:
             self.diagnoseObs("Perform directly", *args, **kwargs)
-            self.performNotify(*args, **kwargs)
+            self.performNotifyDirectly(*args, **kwargs)
 
     def notifyThreaded(self, *args, **kwargs):
         # join the idle handler queue even if we're the main thread
@@ -645,7 +687,7 @@ class Observable:
             self.threadedNotificationHandler.transfer(self, *args, **kwargs)
         else:
             self.diagnoseObs("Perform directly", *args, **kwargs)
-            self.performNotify(*args, **kwargs)
+            self.performNotifyDirectly(*args, **kwargs)
 
     def notifyIfMainThread(self, *args, **kwargs):
         if not self.inMainThread():
@@ -654,6 +696,13 @@ class Observable:
             self.diagnoseObs("Perform directly", *args, **kwargs)
             self.performNotify(*args, **kwargs)
 
+    def performNotifyDirectly(self, *args, **kwargs):
+        if self.directNotificationLock is None:
+            self.performNotify(*args, **kwargs)
+        else:
+            with self.directNotificationLock:
+                self.performNotify(*args, **kwargs)
+
     def performNotify(self, name, *args, **kwargs):
         methodName = "notify" + name
         lastObserver = None
@@ -725,6 +774,9 @@ class TestState(Observable):
     categoryDescriptions = OrderedDict()
     showExecHosts = 0
     defaultBriefText = ""
+    # What gets written in state files, see stateformat. Subclasses add their own fields
+    stateFields = ("category", "briefText", "freeText", "started", "completed", "executionHosts", "lifecycleChange")
+    lazyStateFields = ("freeText",)
 
     def __init__(self, category, freeText="", briefText="", started=0, completed=0,
                  executionHosts=[], lifecycleChange=""):
@@ -740,6 +792,18 @@ class TestState(Observable):
     def __str__(self):
         return self.freeText
 
+    def __getattr__(self, name):
+        # Free text read from a state file isn't decoded until it's needed
+        return stateformat.loadLazyField(self, name)
+
+    def __setattr__(self, name, value):
+        stateformat.discardLazyField(self, name)
+        Observable.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        stateformat.loadLazyFields(self)
+        return self.__dict__
+
     def __repr__(self):
         return self.categoryRepr() + self.hostRepr() + self.colonRepr()
 
@@ -836,6 +900,8 @@ class Unrunnable(TestState):
 
 
 class MarkedTestState(TestState):
+    stateFields = ("oldState", "myFreeText")
+
     def __init__(self, freeText, briefText, oldState, executionHosts=[]):
         self.oldState = oldState
         self.myFreeText = freeText
@@ -862,6 +928,8 @@ class MarkedTestState(TestState):
         return self.oldState.getComparisonsForRecalculation()
 
     def __getattr__(self, name):
+        if name in self.__dict__.get("lazyFields", {}):
+            return TestState.__getattr__(self, name)
         # Anything not implemented should be called on the actual state...
         return getattr(self.oldState, name)
 
@@ -887,6 +955,9 @@ class TestStateUnpickler(Unpickler):
 
 
 def getNewTestStateFromFile(file):
+    if stateformat.isStateFormat(file):
+        return stateformat.load(file)
+    # Older state files, and those sent by slaves, are pickled
     unpickler = TestStateUnpickler(file)
     try:
         return unpickler.load()
@@ -1193,13 +1264,15 @@ def readList(filename):
         return []  # It could be a broken link: don't bail out if so...
 
 
-def readListWithComments(filename, filterMethod=None):
+def readListWithComments(filename, filterMethod=None, lines=None):
     items = OrderedDict()
     badItems = OrderedDict()
     currComment = ""
     emptyLineSymbol = "__EMPTYLINE__"
+    if lines is None:
+        lines = open(filename, encoding=getpreferredencoding(), errors="replace").readlines()
 
-    for longline in open(filename, encoding=getpreferredencoding(), errors="replace").readlines():
+    for longline in lines:
         line = longline.strip()
         if len(line) == 0:
             if currComment:
@@ -1332,6 +1405,8 @@ def roundPercentage(val):
 
 
 class PreviewGenerator:
+    stateFields = ("maxWidth", "maxLength")
+
     def __init__(self, maxWidth, maxLength):
         self.maxWidth = maxWidth
         self.maxLength = maxLength
@@ -1347,7 +1422,8 @@ class PreviewGenerator:
         return self.getPreviewFromLines(fileLines)
 
     def getFileLines(self, file):
-        lines = file.readlines()
+        # Anything past this many lines gets cut anyway, so don't read it
+        lines = list(islice(file, self.maxLength))
         file.close()
         return lines
 
@@ -1571,6 +1647,9 @@ class MultiEntryDictionary(OrderedDict):
     warnings = []
 
     def __init__(self, importKey="", importFileFinder=None, aliases={}, allowSectionHeaders=True, fileTrackSections={}, *args, **kw):
+        # Composite lookups matched against the section keys, cleared whenever anything changes
+        self.compositeCache = {}
+        self.generation = 0
         OrderedDict.__init__(self, *args, **kw)
         self.diag = logging.getLogger("MultiEntryDictionary")
         self.aliases = aliases
@@ -1579,6 +1658,7 @@ class MultiEntryDictionary(OrderedDict):
         self.allowSectionHeaders = allowSectionHeaders
         self.fileTrackSections = fileTrackSections
         self._currentFiles = deque()
+        self.filesRead = []
 
     def __reduce__(self):
         # Need this because of __reduce__ in OrderedDict
@@ -1588,6 +1668,23 @@ class MultiEntryDictionary(OrderedDict):
         return self.__class__, (self.importKey, Callable(self.importFileFinder),
                                 self.aliases, self.allowSectionHeaders, self.fileTrackSections, items)
 
+    def __setitem__(self, key, value):
+        OrderedDict.__setitem__(self, key, value)
+        self.clearCache()
+
+    def __delitem__(self, key):
+        OrderedDict.__delitem__(self, key)
+        self.clearCache()
+
+    def clear(self):
+        OrderedDict.clear(self)
+        self.clearCache()
+
+    def clearCache(self):
+        # Anyone else caching things derived from the config can compare the generation
+        self.compositeCache.clear()
+        self.generation += 1
+
     def addFileTracking(self, key):
         self.fileTrackSections[key] = {}
 
@@ -1610,6 +1707,8 @@ class MultiEntryDictionary(OrderedDict):
     def readFromFile(self, filename, *args, **kwargs):
         self.diag.info("Reading file " + filename)
         self._currentFiles.append(filename)
+        if filename not in self.filesRead:
+            self.filesRead.append(filename)
         currSectionName = ""
         for line in readList(filename):
             if self.allowSectionHeaders and self.isSectionHeader(line):
@@ -1676,6 +1775,7 @@ class MultiEntryDictionary(OrderedDict):
         return ""
 
     def addEntry(self, entryName, entry, sectionName="", *args, **kwargs):
+        self.clearCache()
         currDict, currSection = self.getSectionInfo(sectionName)
         try:
             self._addEntry(entryName, entry, currDict, currSection, *args, **kwargs)
@@ -1684,6 +1784,7 @@ class MultiEntryDictionary(OrderedDict):
                       "' given an invalid value '" + entry + "', ignoring.")
 
     def removeEntry(self, entryName, entry, sectionName=""):
+        self.clearCache()
         currDict, _ = self.getSectionInfo(sectionName)
         if entryName in currDict:
             dictElem = currDict[entryName]
@@ -1769,6 +1870,33 @@ class MultiEntryDictionary(OrderedDict):
             return value
 
     def getCompositeUnexpanded(self, key, subKey, defaultSubKey="default"):
+        # Matching the subkey against every pattern in the section is slow for big sections, and
+        # the same few lookups are made for every test, so remember the answers
+        cacheKey = key, subKey, defaultSubKey
+        if cacheKey in self.compositeCache:
+            value, nested = self.compositeCache[cacheKey]
+        else:
+            value = self._getCompositeUnexpanded(key, subKey, defaultSubKey)
+            nested = self.containsMutables(value)
+            self.compositeCache[cacheKey] = value, nested
+        # Callers have always been free to change what they get back, so they mustn't be given the cached copy
+        if nested:
+            return deepcopy(value)
+        elif type(value) == list:
+            return list(value)
+        else:
+            return value
+
+    @staticmethod
+    def containsMutables(value):
+        if isinstance(value, dict):
+            return True
+        elif type(value) == list:
+            return any(isinstance(item, (list, dict)) for item in value)
+        else:
+            return False
+
+    def _getCompositeUnexpanded(self, key, subKey, defaultSubKey):
         dict = self.get(key)
         # If it wasn't a dictionary, return None
         if not hasattr(dict, "items"):
@@ -1797,10 +1925,12 @@ class MultiEntryDictionary(OrderedDict):
 
     @classmethod
     def expandEnvironment(cls, value, envMapping):
+        # Most values have no variables in them, and substituting needs lookups in the environment
         if isinstance(value, str):
-            return string.Template(value).safe_substitute(envMapping)
+            return string.Template(value).safe_substitute(envMapping) if "$" in value else value
         elif isinstance(value, list):
-            return [string.Template(element).safe_substitute(envMapping) for element in value]
+            return [string.Template(element).safe_substitute(envMapping) if "$" in element else element
+                    for element in value]
         elif isinstance(value, dict):
             newDict = value.__class__()
             for key, val in list(value.items()):
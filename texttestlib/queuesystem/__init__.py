@@ -382,6 +382,8 @@ class QueueSystemConfig(default.Config):
                              "Maximum possible number of parallel tests to run")
         app.setConfigDefault("queue_system_max_reruns", {
                              "default": self.defaultMaxReruns}, "Maximum number of times to rerun tests due to known bugs")
+        app.setConfigDefault("queue_system_longest_first", "false",
+                             "Submit the tests that took longest last time (according to their performance files) first")
         app.setConfigDefault("queue_system_min_test_count", 0,
                              "Minimum number of tests before it's worth submitting them to the grid")
         app.setConfigDefault("queue_system_resource", [],
@@ -396,6 +398,9 @@ class QueueSystemConfig(default.Config):
                              "Executable to run as a proxy for the real test program")
         app.setConfigDefault("queue_system_proxy_resource", [],
                              "Grid engine resources required to locate machine to run proxy process")
+        app.setConfigDefault("queue_system_connection_timeout", 300,
+                             "Seconds to wait for a slave or the master before giving up on its connection " +
+                             "(idle slaves send heartbeats)")
         app.setConfigDefault("queue_system_core_file_location", "",
                              "System-wide location for core files from grid jobs, in case TEXTTEST_TMP is generated")
         app.addConfigEntry("builtin", "proxy_options", "definition_file_stems")
@@ -17,8 +17,9 @@ from texttestlib import plugins
 from texttestlib.default.console import TextDisplayResponder, InteractiveResponder
 from texttestlib.default.knownbugs import CheckForBugs
 from texttestlib.default.actionrunner import BaseActionRunner
-from texttestlib.default.performance import getTestPerformance
+from texttestlib.default.performance import getTestPerformance, getTimeDescription
 from glob import glob
+from io import BytesIO
 from locale import getpreferredencoding
 
 plugins.addCategory("abandoned", "abandoned", "were abandoned")
@@ -44,6 +45,65 @@ class Pending(plugins.TestState):
             return self.__class__(newFreeText, newRunStatus, lifecycleChange)
 
 
+class DurationScheduler:
+    """ Orders tests so that those which took longest last time are submitted first (longest processing time
+    first), so that long tests don't end up starting late and holding up the end of the run """
+    def __init__(self):
+        self.tests = []
+        self.ordered = False
+        self.predictedMakespan = None
+        self.startTime = None
+        self.diag = logging.getLogger("Queue System Submit")
+
+    def addTest(self, test):
+        # Once the initial ordering is done, later tests can't be held back: the caller must submit them directly
+        if self.ordered:
+            return False
+        self.tests.append(test)
+        return True
+
+    def getDuration(self, test):
+        try:
+            return getTestPerformance(test)
+        except (IOError, ValueError, IndexError):  # IndexError from empty or malformed performance files
+            return float(-1)
+
+    def getOrderedTests(self, capacity):
+        self.ordered = True
+        if not self.tests:
+            return []
+        durations = [(self.getDuration(test), test) for test in self.tests]
+        known = [duration for duration, _ in durations if duration >= 0]
+        # Tests without a performance file are assumed to be average
+        default = sum(known) / len(known) if known else 0.0
+        estimates = [(duration if duration >= 0 else default, index, test)
+                     for index, (duration, test) in enumerate(durations)]
+        # Stable: tests with the same duration stay in test-tree order
+        estimates.sort(key=lambda item: (-item[0], item[1]))
+        self.predictedMakespan = self.predictMakespan([duration for duration, _, _ in estimates], capacity)
+        self.diag.info("Ordered " + str(len(estimates)) + " tests by duration, predicted makespan " +
+                       repr(self.predictedMakespan))
+        self.tests = []
+        return [test for _, _, test in estimates]
+
+    def predictMakespan(self, durations, capacity):
+        # Each test goes to whichever slot frees up first, as happens when submitting to the grid
+        slots = [0.0] * max(1, min(capacity, len(durations)))
+        for duration in durations:
+            slots[slots.index(min(slots))] += duration
+        return max(slots)
+
+    def notifySubmitted(self):
+        if self.startTime is None:
+            self.startTime = time.time()
+
+    def reportMakespan(self):
+        if self.predictedMakespan is not None and self.startTime is not None:
+            actual = time.time() - self.startTime
+            plugins.log.info("Tests submitted longest first: predicted time " + getTimeDescription(self.predictedMakespan) +
+                             ", actual time " + getTimeDescription(actual))
+
+
 class QueueSystemServer(BaseActionRunner):
     instance = None
 
@@ -68,6 +128,7 @@ class QueueSystemServer(BaseActionRunner):
         self.slaveLogDirs = set()
         self.delayedTestsForAdd = []
         self.remainingForApp = OrderedDict()
+        self.durationScheduler = DurationScheduler()
         appCapacities = []
         for app in allApps:
             appCapacity = self.maxCapacity
@@ -113,6 +174,11 @@ class QueueSystemServer(BaseActionRunner):
     def addTest(self, test):
         if self.createDirectories:
             test.makeWriteDirectory()
+        # Can't submit anything until we know what's longest
+        if test.getConfigValue("queue_system_longest_first") != "true" or not self.durationScheduler.addTest(test):
+            self.addTestWithinCapacity(test)
+
+    def addTestWithinCapacity(self, test):
         capacityForApp = self.remainingForApp[test.app.name]
         if capacityForApp > 0:
             self.addTestToQueues(test)
@@ -141,6 +207,8 @@ class QueueSystemServer(BaseActionRunner):
         self.delayedTestsForAdd = []
 
     def notifyAllRead(self, suites):
+        for test in self.durationScheduler.getOrderedTests(self.maxCapacity):
+            self.addTestWithinCapacity(test)
         self.addDelayedTests()
         BaseActionRunner.notifyAllRead(self, suites)
         self.allRead = True
@@ -363,6 +431,7 @@ class QueueSystemServer(BaseActionRunner):
 
     def notifyAllComplete(self):
         BaseActionRunner.notifyAllComplete(self)
+        self.durationScheduler.reportMakespan()
         self.cleanup(final=True)
         if self.reuseOnly: # could still be hanging waiting for this, make sure we terminate
             self.submitTerminators()
@@ -409,6 +478,7 @@ class QueueSystemServer(BaseActionRunner):
         if not self.submitJob(test, submissionRules, commandArgs, slaveEnv):
             return
 
+        self.durationScheduler.notifySubmitted()
         with self.counterLock:
             self.testCount -= 1
             self.testsSubmitted += 1
@@ -953,12 +1023,64 @@ class TestSubmissionRules(SubmissionRules):
 
 
 class SlaveRequestHandler(StreamRequestHandler):
+    persistent = False
+
     def handle(self):
         identifier = str(self.rfile.readline().strip(), getpreferredencoding())
         if identifier == "TERMINATE_SERVER":
             return
 
-        self.handleMessage(identifier)
+        if identifier == persistentConnectionText:
+            self.handlePersistentConnection()
+        else:
+            self.handleMessage(identifier)
+            self.shutdownConnection(socket.SHUT_RDWR)
+
+    def handlePersistentConnection(self):
+        # One connection per slave, carrying messages for all the tests it runs.
+        # Each message is in the same format as on a single-shot connection, but is sent as a stream of
+        # length-prefixed frames (see ChunkedWriter), so it can be read as it arrives. The response is one frame
+        # containing what would have been written. Empty messages are heartbeats, and are answered in kind.
+        self.persistent = True
+        self.connection.settimeout(self.server.connectionTimeout)
+        connectionReader, connectionWriter = self.rfile, self.wfile
+        clientHost = self.getHostName(self.client_address[0])
+        self.server.diag.info("Opened persistent connection from " + clientHost)
+        try:
+            self.handlePersistentMessages(connectionReader, connectionWriter, clientHost)
+        finally:
+            # StreamRequestHandler.finish closes these
+            self.rfile, self.wfile = connectionReader, connectionWriter
+        self.server.diag.info("Closed persistent connection from " + clientHost)
+
+    def handlePersistentMessages(self, connectionReader, connectionWriter, clientHost):
+        while True:
+            message = ChunkedReader(connectionReader)
+            try:
+                if message.atEnd():
+                    response = b""
+                else:
+                    self.rfile, self.wfile = message, BytesIO()
+                    identifier = str(self.rfile.readline().strip(), getpreferredencoding())
+                    self.handleMessage(identifier)
+                    message.drain()
+                    response = self.wfile.getvalue()
+            except socket.timeout:
+                sys.stderr.write("WARNING: Nothing received from slave at hostname " + clientHost +
+                                 " for " + str(self.server.connectionTimeout) + " seconds, closing connection.\n")
+                return
+            if message.connectionClosed:
+                return
+            connectionWriter.write(makeFrame(response))
+
+    def shutdownConnection(self, how):
+        if self.persistent:
+            return
+        try:
+            self.connection.shutdown(how)
+        except socket.error:
+            # This only occurs on a mac, and doesn't affect functionality.
+            pass
 
     def handleMessage(self, identifier):
         # Don't use port, it changes all the time
@@ -981,11 +1103,6 @@ class SlaveRequestHandler(StreamRequestHandler):
         else:
             self.server.diag.info("Test " + test.uniqueName + " already complete, ignoring new results")
             self.sendReuseResponse(test, test.state, tryReuse, False)
-        try:
-            self.connection.shutdown(socket.SHUT_RDWR)
-        except socket.error:
-            # This only occurs on a mac, and doesn't affect functionality.
-            pass
 
     def getHostName(self, ipAddress):
         try:
@@ -1015,11 +1132,7 @@ class SlaveRequestHandler(StreamRequestHandler):
         if test.state.isComplete():
             state.lifecycleChange = "recalculated"
         doneRerun = self.server.changeStateOrRerun(test, state, rerun)
-        try:
-            self.connection.shutdown(socket.SHUT_RD)
-        except socket.error:
-            # This only occurs on a mac, and doesn't affect functionality.
-            pass
+        self.shutdownConnection(socket.SHUT_RD)
         if state.isComplete():
             self.sendReuseResponse(test, state, tryReuse, doneRerun)
         else:
@@ -1030,6 +1143,8 @@ class SlaveServerResponder(plugins.Responder, ThreadingTCPServer):
     # Python's default value of 5 isn't very much...
     # There doesn't seem to be any disadvantage of allowing a longer queue, so we will use the system's maximum size
     request_queue_size = socket.SOMAXCONN
+    # Persistent connections block reading from their slave, which mustn't stop us exiting if the slave hangs
+    daemon_threads = True
 
     def __init__(self, optionMap, allApps):
         plugins.Responder.__init__(self)
@@ -1043,6 +1158,7 @@ class SlaveServerResponder(plugins.Responder, ThreadingTCPServer):
         self.totalReruns = 0
         self.maxReruns = max(filter(lambda x: x is not None,
                                     (app.getBatchConfigValue("queue_system_max_reruns") for app in allApps)))
+        self.connectionTimeout = getConnectionTimeout(allApps)
 
         # If a client rings in and then the connectivity is lost, we don't want to hang waiting for it forever
         # So we enable keepalive that will check the connection if no data is received for a while
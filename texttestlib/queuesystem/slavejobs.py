@@ -9,6 +9,7 @@ import time
 import socket
 import signal
 import logging
+from threading import Lock, Thread
 from .utils import *
 from texttestlib import plugins
 from texttestlib.default.runtest import RunTest
@@ -70,13 +71,21 @@ class RedirectLogResponder(plugins.Responder):
 class SocketResponder(plugins.Responder, plugins.Observable):
     synchFiles = False
 
-    def __init__(self, optionMap, *args):
+    def __init__(self, optionMap, allApps):
         plugins.Responder.__init__(self)
         plugins.Observable.__init__(self)
         self.killed = False
         self.transferAll = optionMap.get("keepslave") or optionMap.get("keeptmp")
         self.testsForRerun = []
         self.serverAddress = self.getServerAddress(optionMap)
+        # One connection for everything we send, kept alive by heartbeats when we have nothing to say
+        self.connection = None
+        self.connectionReader = None
+        self.connectionWriter = None
+        self.connectionLock = Lock()
+        self.connectionTimeout = getConnectionTimeout(allApps)
+        self.lastSendTime = time.time()
+        self.heartbeatThread = None
 
     def getServerAddress(self, optionMap):
         servAddrStr = optionMap.get("servaddr", os.getenv("CAPTUREMOCK_SERVER"))
@@ -121,43 +130,96 @@ class SocketResponder(plugins.Responder, plugins.Observable):
         pickleData = dumps(state, protocol=protocol)
         sendFiles = self.synchFiles and changeDesc == "complete" and (self.transferAll or not test.state.hasSucceeded())
         fullData = self.getProcessIdentifier(test, sendFiles) + os.linesep + testData + os.linesep
-        if sendFiles:
-            fullData += directorySerialise(test.writeDirectory) + os.linesep
-        fullDataBytes = fullData.encode(getpreferredencoding()) + pickleData
-        return self.sendAndInterpret(fullDataBytes, self.interpretResponse, state)
 
-    def sendAndInterpret(self, fullData, responseMethod, *args):
+        def writeMessage(message):
+            message.write(fullData.encode(getpreferredencoding()))
+            if sendFiles:
+                # Goes straight to the socket as it's produced, and is produced again if we have to resend
+                directorySerialise(test.writeDirectory, message)
+            message.write(pickleData)
+        return self.sendAndInterpret(writeMessage, self.interpretResponse, state)
+
+    def sendAndInterpret(self, writeMethod, responseMethod, *args):
         sleepTime = 1
         for _ in range(9):
-            sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            if not self.connect(sendSocket):
-                return self.notify("NoMoreExtraTests")
-            try:
-                response = self.sendData(sendSocket, fullData)
+            with self.connectionLock:
+                if self.connection is None and not self.openConnection():
+                    return self.notify("NoMoreExtraTests")
+                try:
+                    response = self.sendData(writeMethod)
+                    sent = True
+                except socket.error as e:
+                    self.closeConnection()
+                    errorText = self.exceptionOutput()
+                    plugins.log.info("Failed to communicate with master process - waiting " +
+                                     str(sleepTime) + " seconds and then trying again.")
+                    plugins.log.info("Error received was " + str(e))
+                    sent = False
+            if sent:
                 return responseMethod(response, *args) if responseMethod else True
-            except socket.error as e:
-                plugins.log.info("Failed to communicate with master process - waiting " +
-                                 str(sleepTime) + " seconds and then trying again.")
-                plugins.log.info("Error received was " + str(e))
-                time.sleep(sleepTime)
-                sleepTime *= 2
-
-        message = "Terminating as failed to communicate with master process : " + self.exceptionOutput()
+            # Don't hold the connection while we wait, the heartbeats and other senders need it
+            time.sleep(sleepTime)
+            sleepTime *= 2
+
+        message = "Terminating as failed to communicate with master process : " + errorText
         sys.stderr.write(message)
         plugins.log.info(message.strip())
         self.notify("NoMoreExtraTests")
 
-    def sendData(self, sendSocket, fullData):
-        sendSocket.sendall(fullData)
-        sendSocket.shutdown(socket.SHUT_WR)
-        if self.synchFiles:
-            # Remote socket, possibly firewalls that kill connections, possibly other things. Use timeout and be prepared to retry...
-            # TCP timeout is typically 30 seconds, give up a bit before that
-            sendSocket.settimeout(25)
-        response = sendSocket.makefile('rb').read()
-        sendSocket.close()
+    def openConnection(self):
+        sendSocket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        if not self.connect(sendSocket):
+            return False
+        # Remote socket, possibly firewalls that kill connections, possibly other things.
+        # Don't wait longer than the master would before giving up on us
+        sendSocket.settimeout(self.connectionTimeout)
+        sendSocket.sendall((persistentConnectionText + "\n").encode(getpreferredencoding()))
+        self.connection = sendSocket
+        self.connectionReader = sendSocket.makefile("rb")
+        self.connectionWriter = sendSocket.makefile("wb")
+        if self.heartbeatThread is None:
+            self.heartbeatThread = Thread(target=self.sendHeartbeats, name="SlaveHeartbeat", daemon=True)
+            self.heartbeatThread.start()
+        return True
+
+    def closeConnection(self):
+        if self.connection is not None:
+            self.connectionReader.close()
+            try:
+                self.connectionWriter.close()
+            except socket.error:
+                # Flushing what's left of a failed message
+                pass
+            self.connection.close()
+            self.connection = None
+            self.connectionReader = None
+            self.connectionWriter = None
+
+    def sendData(self, writeMethod=None):
+        # Each message is sent as a chunked stream, an empty one is a heartbeat
+        message = ChunkedWriter(self.connectionWriter)
+        if writeMethod:
+            writeMethod(message)
+        message.close()
+        self.connectionWriter.flush()
+        self.lastSendTime = time.time()
+        response = readFrame(self.connectionReader)
+        if response is None:
+            raise socket.error("Connection closed by master process")
         return str(response, getpreferredencoding())
 
+    def sendHeartbeats(self):
+        heartbeatInterval = self.connectionTimeout / heartbeatsPerTimeout
+        while True:
+            time.sleep(heartbeatInterval)
+            with self.connectionLock:
+                if self.connection is not None and time.time() - self.lastSendTime >= heartbeatInterval:
+                    try:
+                        self.sendData()
+                    except socket.error:
+                        # Reconnect next time we have something to send
+                        self.closeConnection()
+
     def interpretResponse(self, response, state):
         if len(response) > 0:
             appDesc, testPath = socketParse(response)
@@ -172,7 +234,8 @@ class SocketResponder(plugins.Responder, plugins.Observable):
                 plugins.log.info(test.getIndent() + "Fetching required test data at " + repr(path) + " ...")
             data = makeIdentifierLine(str(os.getpid()), getFiles=True) + "\n" + socketSerialise(test) + "\n" + \
                 getUserName() + "@" + getIPAddress([test]) + "\n" + "\n".join(paths)
-            self.sendAndInterpret(data.encode(getpreferredencoding()), None)  # Just wait, no response to interpret
+            message = data.encode(getpreferredencoding())
+            self.sendAndInterpret(lambda f: f.write(message), None)  # Just wait, no response to interpret
 
 
 class SlaveActionRunner(ActionRunner):
@@ -5,6 +5,8 @@ Utilities for both master and slave code
 
 import os
 import socket
+import struct
+import tarfile
 from texttestlib import plugins
 from locale import getpreferredencoding
 
@@ -13,6 +15,17 @@ rerunPostfix = ".RERUN_TEST"
 sendFilePostfix = ".SEND_FILES"
 getFilePostfix = ".GET_FILES"
 
+# Sent by slaves that keep one connection open for all their messages, rather than connecting once per message
+persistentConnectionText = "PERSISTENT_CONNECTION"
+# Slaves send an empty message when they've been quiet for this fraction of queue_system_connection_timeout,
+# the master gives up on them when they've been quiet for all of it
+heartbeatsPerTimeout = 5
+frameHeader = struct.Struct(">I")
+
+
+def getConnectionTimeout(apps):
+    return max((app.getConfigValue("queue_system_connection_timeout") for app in apps))
+
 
 def getIPAddress(apps):
     if useLocalQueueSystem(apps):
@@ -80,43 +93,129 @@ def parseIdentifier(line):
     return line, sendFiles, getFiles, tryReuse, rerun
 
 
+def makeFrame(data):
+    return frameHeader.pack(len(data)) + data
+
+
+def readFrame(f):
+    # Returns None if the connection is closed before we get a whole frame
+    header = f.read(frameHeader.size)
+    if len(header) < frameHeader.size:
+        return None
+    length, = frameHeader.unpack(header)
+    data = f.read(length)
+    if len(data) < length:
+        return None
+    return data
+
+
 dirText = "DIRECTORY_CONTENTS"
-fileText = "FILE_CONTENTS"
-endPrefix = "END_"
-
-
-def directorySerialise(dirName, ignoreLinks=False):
-    text = ""
-    for root, _, files in os.walk(dirName):
-        for fn in sorted(files):
-            path = os.path.join(root, fn)
-            if not os.path.islink(path):
-                relpath = plugins.relpath(path, dirName)
-                text += fileText + " " + relpath + "\n"
-                with open(path) as f:
-                    text += f.read()
-                if not text.endswith("\n"):
-                    text += "\n"
-                text += endPrefix + fileText + "\n"
-    text += endPrefix + dirText
-    return text
+# Any compression tarfile can stream, named in the header so the master knows how to unpack it
+transferCompression = "gz"
+transferChunkSize = 64 * 1024
+
+
+class ChunkedWriter:
+    """ File-like object that writes everything as frames of up to transferChunkSize, ended by an empty one,
+    so the reader knows where the data ends without it being measured in advance """
+    def __init__(self, f):
+        self.file = f
+        self.buffer = bytearray()
+
+    def write(self, data):
+        self.buffer += data
+        while len(self.buffer) >= transferChunkSize:
+            self.file.write(makeFrame(bytes(self.buffer[:transferChunkSize])))
+            del self.buffer[:transferChunkSize]
+        return len(data)
+
+    def close(self):
+        if self.buffer:
+            self.file.write(makeFrame(bytes(self.buffer)))
+            self.buffer.clear()
+        self.file.write(makeFrame(b""))
+
+
+class ChunkedReader:
+    """ Reads what a ChunkedWriter wrote, leaving the underlying file just after it """
+    def __init__(self, f):
+        self.file = f
+        self.buffer = bytearray()
+        self.finished = False
+        self.connectionClosed = False
+
+    def readChunk(self):
+        chunk = readFrame(self.file)
+        if chunk:
+            self.buffer += chunk
+        else:
+            self.finished = True
+            self.connectionClosed = chunk is None
+
+    def atEnd(self):
+        while not self.finished and not self.buffer:
+            self.readChunk()
+        return not self.buffer
+
+    def peek(self, size=1):
+        while not self.finished and len(self.buffer) < size:
+            self.readChunk()
+        return bytes(self.buffer[:size])
+
+    def readline(self, size=-1):
+        searchFrom = 0
+        while not self.finished and self.buffer.find(b"\n", searchFrom) == -1:
+            searchFrom = len(self.buffer)
+            self.readChunk()
+        pos = self.buffer.find(b"\n", searchFrom)
+        end = pos + 1 if pos != -1 else len(self.buffer)
+        return self.read(end if size < 0 else min(end, size))
+
+    def __iter__(self):
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def read(self, size=-1):
+        while not self.finished and (size < 0 or len(self.buffer) < size):
+            self.readChunk()
+        if size < 0:
+            size = len(self.buffer)
+        data = bytes(self.buffer[:size])
+        del self.buffer[:size]
+        return data
+
+    def drain(self):
+        while not self.finished:
+            self.readChunk()
+        self.buffer.clear()
+
+
+def directorySerialise(dirName, f):
+    # Streams a compressed tar archive of the files in dirName to the binary file f, a chunk at a time
+    f.write((dirText + " " + transferCompression + "\n").encode(getpreferredencoding()))
+    writer = ChunkedWriter(f)
+    with tarfile.open(fileobj=writer, mode="w|" + transferCompression, bufsize=transferChunkSize) as tar:
+        for root, _, files in os.walk(dirName):
+            for fn in sorted(files):
+                path = os.path.join(root, fn)
+                if not os.path.islink(path):
+                    tar.add(path, arcname=plugins.relpath(path, dirName), recursive=False)
+    writer.close()
 
 
 def directoryUnserialise(rootDir, f):
-    currFile = None
-    for line in f:
-        lineStr = str(line, getpreferredencoding())
-        if currFile is not None:
-            if lineStr.startswith(endPrefix + fileText):
-                currFile.close()
-                currFile = None
-            else:
-                currFile.write(lineStr)
-        else:
-            if lineStr.startswith(fileText):
-                fn = lineStr.strip().split()[-1]
-                path = os.path.join(rootDir, fn)
-                plugins.ensureDirExistsForFile(path)
-                currFile = open(path, "w")
-            elif lineStr.startswith(endPrefix + dirText):
-                break
+    # Unpacks as it reads, so we never hold the whole archive in memory
+    header = str(f.readline(), getpreferredencoding()).split()
+    compression = header[1] if len(header) > 1 else ""
+    reader = ChunkedReader(f)
+    # Don't allow anything to be written outside the write directory
+    extractArgs = {"filter": "data"} if hasattr(tarfile, "data_filter") else {}
+    with tarfile.open(fileobj=reader, mode="r|" + compression, bufsize=transferChunkSize) as tar:
+        for member in tar:
+            if member.isfile():
+                tar.extract(member, rootDir, **extractArgs)
+    # tarfile stops at the end-of-archive marker, there may be padding after it
+    reader.drain()
@@ -0,0 +1,265 @@
+"""
+Compact, versioned format for the saved test state files, used instead of pickle where possible.
+
+The file is a header line, a zlib-compressed JSON tree describing the state objects, and a separately
+compressed block holding the heavy text (free text, difference previews). Each class declares the fields
+it stores in 'stateFields'. Their names are written once per class in the file, and each object just lists
+its values in that order. When reading, fields the class no longer has are ignored and fields the file
+doesn't have are left to the class defaults, so adding or removing state fields doesn't make older files
+unreadable. Fields named in
+'lazyStateFields' go into the text block, which is only decompressed when one of them is first used, so
+reading a state just to find its category and summary doesn't pay for the detail.
+"""
+
+import json
+import zlib
+from importlib import import_module
+
+# Version 1 didn't store the field names, so can only be read if the fields haven't changed since
+formatVersion = 2
+magic = b"TEXTTEST_STATE"
+
+
+class StateFormatError(ValueError):
+    pass
+
+
+class UnsupportedValue(Exception):
+    # The state holds something the format can't describe: save it with pickle instead
+    pass
+
+
+def isStateFormat(file):
+    if hasattr(file, "peek"):
+        start = file.peek(len(magic))[:len(magic)]
+    else:
+        pos = file.tell()
+        start = file.read(len(magic))
+        file.seek(pos)
+    return start == magic
+
+
+def getClassFields(cls, attrName):
+    fields = []
+    for baseClass in reversed(cls.__mro__):
+        for field in baseClass.__dict__.get(attrName, ()):
+            if field not in fields:
+                fields.append(field)
+    return fields
+
+
+def getClassPath(cls):
+    return cls.__module__ + ":" + cls.__qualname__
+
+
+def findClass(classPath):
+    modName, className = classPath.split(":")
+    try:
+        cls = import_module(modName)
+        for name in className.split("."):
+            cls = getattr(cls, name)
+        return cls
+    except (ImportError, AttributeError):
+        raise StateFormatError("Could not find class " + classPath + " referred to in state file")
+
+
+def dumps(state):
+    encoder = StateEncoder()
+    tree = {"s": encoder.encode(state), "k": encoder.classes}
+    mainBlock = zlib.compress(json.dumps(tree, separators=(",", ":")).encode())
+    textBlock = zlib.compress(json.dumps(encoder.texts, separators=(",", ":")).encode())
+    header = magic + b" " + str(formatVersion).encode() + b" " + str(len(mainBlock)).encode() + b"\n"
+    return header + mainBlock + textBlock
+
+
+def load(file):
+    header = file.readline().split()
+    if len(header) != 3 or header[0] != magic:
+        raise StateFormatError("Not a TextTest state file")
+    version, mainLength = int(header[1]), int(header[2])
+    if version > formatVersion:
+        raise StateFormatError("State file has format version " + str(version) +
+                               ", this version of TextTest can only read up to version " + str(formatVersion))
+    mainBlock = file.read(mainLength)
+    textBlock = TextBlock(file.read())
+    try:
+        tree = json.loads(zlib.decompress(mainBlock).decode())
+    except zlib.error as e:
+        raise StateFormatError("Corrupted state file: " + str(e))
+    if version == 1:
+        return StateDecoder(textBlock).decode(tree)
+    else:
+        return StateDecoder(textBlock, tree["k"]).decode(tree["s"])
+
+
+def loadLazyField(obj, name):
+    # Called from __getattr__ of classes with 'lazyStateFields'
+    lazyFields = obj.__dict__.get("lazyFields")
+    if not lazyFields or name not in lazyFields:
+        raise AttributeError(name)
+    source, index = lazyFields.pop(name)
+    if not lazyFields:
+        del obj.__dict__["lazyFields"]
+    value = source.getText(index)
+    obj.__dict__[name] = value
+    return value
+
+
+def setLazyField(obj, name, source, index=0):
+    # Anything with a getText(index) method can provide the value, which is asked for when it's first used
+    obj.__dict__.pop(name, None)
+    obj.__dict__.setdefault("lazyFields", {})[name] = source, index
+
+
+def discardLazyField(obj, name):
+    # Called from __setattr__, so that a value assigned isn't replaced later by the one that was pending
+    lazyFields = obj.__dict__.get("lazyFields")
+    if lazyFields and name in lazyFields:
+        del lazyFields[name]
+        if not lazyFields:
+            del obj.__dict__["lazyFields"]
+
+
+def loadLazyFields(obj):
+    # Needed before copying or pickling the object
+    for name in list(obj.__dict__.get("lazyFields", [])):
+        loadLazyField(obj, name)
+
+
+class TextBlock:
+    def __init__(self, data):
+        self.data = data
+        self.texts = None
+
+    def getText(self, index):
+        if self.texts is None:
+            try:
+                self.texts = json.loads(zlib.decompress(self.data).decode())
+            except (zlib.error, ValueError) as e:
+                raise StateFormatError("Corrupted text in state file: " + str(e))
+            self.data = None
+        return self.texts[index]
+
+
+class StateEncoder:
+    def __init__(self):
+        self.objectIndices = {}
+        self.objects = []
+        self.texts = []
+        self.classIndices = {}
+        self.classes = []
+
+    def encode(self, value):
+        valueType = type(value)
+        if value is None or valueType in (bool, int, float, str):
+            return value
+        elif valueType is list:
+            return [self.encode(item) for item in value]
+        elif valueType is tuple:
+            return {"t": [self.encode(item) for item in value]}
+        elif valueType is dict:
+            return {"d": [[self.encode(key), self.encode(item)] for key, item in value.items()]}
+        else:
+            return self.encodeObject(value)
+
+    def encodeObject(self, obj):
+        objId = id(obj)
+        if objId in self.objectIndices:
+            return {"r": self.objectIndices[objId]}
+
+        cls = obj.__class__
+        schema = getClassFields(cls, "stateFields")
+        if not schema:
+            raise UnsupportedValue("No state fields defined for " + getClassPath(cls))
+        # Index in the order we start them, so references to objects still being written work
+        self.objectIndices[objId] = len(self.objects)
+        self.objects.append(obj)
+        fields = obj.__getstate__() if hasattr(cls, "__getstate__") else obj.__dict__
+        if fields is None:
+            fields = {}
+        elif type(fields) is not dict:
+            raise UnsupportedValue("Cannot store custom state of " + getClassPath(cls))
+        lazyFields = getClassFields(cls, "lazyStateFields")
+        values = [self.encodeField(name, fields[name], lazyFields) if name in fields else {"u": 0} for name in schema]
+        node = {"c": self.getClassIndex(cls, schema), "v": values}
+        extras = {name: self.encode(value) for name, value in fields.items() if name not in schema}
+        if extras:
+            node["e"] = extras
+        return node
+
+    def getClassIndex(self, cls, schema):
+        if cls not in self.classIndices:
+            self.classIndices[cls] = len(self.classes)
+            self.classes.append([getClassPath(cls), schema])
+        return self.classIndices[cls]
+
+    def encodeField(self, name, value, lazyFields):
+        if name in lazyFields and type(value) is str and value:
+            self.texts.append(value)
+            return {"x": len(self.texts) - 1}
+        else:
+            return self.encode(value)
+
+
+class StateDecoder:
+    def __init__(self, textBlock, classes=None):
+        self.textBlock = textBlock
+        self.objects = []
+        # Class path and stored field names for each class index. Not present in version 1 files
+        self.classes = classes
+        self.classInfo = {}
+
+    def decode(self, node):
+        if type(node) is list:
+            return [self.decode(item) for item in node]
+        elif type(node) is not dict:
+            return node
+        elif "c" in node:
+            return self.decodeObject(node)
+        elif "r" in node:
+            return self.objects[node["r"]]
+        elif "t" in node:
+            return tuple(self.decode(item) for item in node["t"])
+        elif "d" in node:
+            return {self.decode(key): self.decode(item) for key, item in node["d"]}
+        else:
+            raise StateFormatError("Unexpected entry in state file: " + repr(node))
+
+    def getClassInfo(self, classRef):
+        if classRef not in self.classInfo:
+            if self.classes is None:
+                cls = findClass(classRef)
+                storedFields = getClassFields(cls, "stateFields")
+                knownFields = set(storedFields)
+            else:
+                classPath, storedFields = self.classes[classRef]
+                cls = findClass(classPath)
+                knownFields = set(getClassFields(cls, "stateFields"))
+            self.classInfo[classRef] = cls, storedFields, knownFields
+        return self.classInfo[classRef]
+
+    def decodeObject(self, node):
+        cls, storedFields, knownFields = self.getClassInfo(node["c"])
+        if len(storedFields) != len(node["v"]):
+            raise StateFormatError("State fields for " + getClassPath(cls) + " do not match those in the state file")
+        obj = cls.__new__(cls)
+        self.objects.append(obj)
+        fields, lazyFields = {}, {}
+        for name, value in zip(storedFields, node["v"]):
+            if type(value) is dict and "x" in value:
+                if name in knownFields:
+                    lazyFields[name] = self.textBlock, value["x"]
+            elif type(value) is not dict or "u" not in value:
+                # Fields the class no longer has are still decoded, as objects are numbered in the order they're met
+                decoded = self.decode(value)
+                if name in knownFields:
+                    fields[name] = decoded
+        for name, value in node.get("e", {}).items():
+            fields[name] = self.decode(value)
+        if hasattr(cls, "__setstate__"):
+            obj.__setstate__(fields)
+        else:
+            obj.__dict__.update(fields)
+        if lazyFields:
+            obj.__dict__["lazyFields"] = lazyFields
+        return obj
@@ -1,5 +1,5 @@
 #!/usr/bin/env python
-from . import plugins
+from . import plugins, stateformat
 import os
 import sys
 import types
@@ -10,14 +10,17 @@ import logging
 import glob
 import functools
 import fnmatch
+import time
 
 from multiprocessing import cpu_count
 from collections import OrderedDict
-from pickle import Pickler, Unpickler, UnpicklingError
+from pickle import dump, dumps, load, Unpickler, UnpicklingError, HIGHEST_PROTOCOL
 from threading import Lock
+from concurrent.futures import ThreadPoolExecutor
 from tempfile import mkstemp, mkdtemp
 from copy import deepcopy
 from functools import reduce, cmp_to_key
+from bisect import bisect_left
 from locale import getpreferredencoding
 
 helpIntro = """
@@ -27,27 +30,195 @@ http://www.texttest.org
 """
 
 
+class TestTreeSnapshot:
+    """ Directory listings and test suite files from reading the test tree before, stored in one file.
+    They are reused while the directory or file is unchanged, so on a slow file system reading
+    a large test tree needs little more than a stat of each directory and file """
+    formatVersion = 1
+    # Anything changed more recently than this might change again without its time changing
+    minimumAge = 2
+    instances = {}
+
+    @classmethod
+    def forFile(cls, fileName):
+        if fileName not in cls.instances:
+            cls.instances[fileName] = cls(fileName)
+        return cls.instances[fileName]
+
+    def __init__(self, fileName):
+        self.fileName = fileName
+        self.diag = logging.getLogger("Test tree snapshot")
+        self.listings = {}
+        self.fileLines = {}
+        self.changed = False
+        # Paths looked up in this run, and those in the file as last read or written
+        self.usedPaths = set()
+        self.savedPaths = set()
+        self.lock = Lock()
+        self.read()
+
+    def read(self):
+        try:
+            with open(self.fileName, "rb") as f:
+                data = load(f)
+            if data.get("version") == self.formatVersion:
+                self.listings, self.fileLines = data["listings"], data["files"]
+                self.savedPaths = set(self.listings) | set(self.fileLines)
+                self.diag.info("Read snapshot from " + self.fileName)
+        except Exception as e:
+            # Missing or unreadable, we just start again
+            self.diag.info("Could not read snapshot from " + self.fileName + " : " + str(e))
+
+    def save(self):
+        with self.lock:
+            # Anything not looked up in this run has been removed, or isn't part of the test tree any more
+            listings = self.getUsedEntries(self.listings)
+            fileLines = self.getUsedEntries(self.fileLines)
+            paths = set(listings) | set(fileLines)
+            if not self.changed and paths == self.savedPaths:
+                return
+            data = {"version": self.formatVersion, "listings": listings, "files": fileLines}
+            self.savedPaths = paths
+            self.changed = False
+        try:
+            plugins.ensureDirExistsForFile(self.fileName)
+            tmpFileName = self.fileName + "." + str(os.getpid())
+            with open(tmpFileName, "wb") as f:
+                dump(data, f, protocol=HIGHEST_PROTOCOL)
+            # Other runs might be reading or writing it at the same time
+            os.replace(tmpFileName, self.fileName)
+        except OSError as e:
+            plugins.printWarning("Could not write test tree snapshot to " + self.fileName + " : " + str(e))
+
+    def getUsedEntries(self, cache):
+        return dict((path, entry) for path, entry in cache.items() if path in self.usedPaths)
+
+    def getSignature(self, path):
+        statInfo = os.stat(path)
+        return statInfo.st_mtime_ns, statInfo.st_size, statInfo.st_ino
+
+    def getCached(self, cache, path, readMethod):
+        signature = self.getSignature(path)
+        with self.lock:
+            self.usedPaths.add(path)
+            entry = cache.get(path)
+            if entry and entry[0] == signature:
+                return entry[1]
+        value = readMethod(path)
+        if time.time() - signature[0] / 1e9 > self.minimumAge:
+            with self.lock:
+                cache[path] = signature, value
+                self.changed = True
+        return value
+
+    def getListing(self, dirName):
+        return list(self.getCached(self.listings, dirName, lambda d: sorted(os.listdir(d))))
+
+    def getLines(self, fileName):
+        return self.getCached(self.fileLines, fileName, self.readLines)
+
+    @staticmethod
+    def readLines(fileName):
+        with open(fileName, encoding=getpreferredencoding(), errors="replace") as f:
+            return f.readlines()
+
+
+class TestTreePrefetcher:
+    """ Lists the test directories and reads the test suite files in a pool of threads, following the suite
+    files downwards as soon as they are read. The test tree is still built in the usual order from what this
+    has read, so it comes out the same, but the waiting for the file system happens in parallel """
+
+    def __init__(self, appName, threads, snapshot=None):
+        self.suiteFilePrefix = "testsuite." + appName
+        self.snapshot = snapshot
+        self.executor = ThreadPoolExecutor(threads)
+        self.listings = {}
+        self.fileLines = {}
+        self.lock = Lock()
+
+    def stop(self):
+        self.executor.shutdown(wait=False, cancel_futures=True)
+
+    def submit(self, cache, path, method):
+        with self.lock:
+            if path not in cache:
+                cache[path] = self.executor.submit(method, path)
+
+    def readDirectory(self, dirName):
+        self.submit(self.listings, dirName, self.listDirectory)
+
+    def listDirectory(self, dirName):
+        contents = self.snapshot.getListing(dirName) if self.snapshot else sorted(os.listdir(dirName))
+        for fileName in contents:
+            # Version files of the suite file might add tests too
+            if fileName.startswith(self.suiteFilePrefix):
+                self.submit(self.fileLines, os.path.join(dirName, fileName), self.readSuiteFile)
+        return contents
+
+    def readSuiteFile(self, fileName):
+        lines = self.snapshot.getLines(fileName) if self.snapshot else TestTreeSnapshot.readLines(fileName)
+        dirName = os.path.dirname(fileName)
+        for line in lines:
+            testName = line.strip()
+            if testName and not testName.startswith("#"):
+                self.readDirectory(os.path.join(dirName, testName))
+        return lines
+
+    def getResult(self, cache, path, method):
+        future = cache.get(path)
+        if future is None or future.cancelled():
+            return method(path)
+        else:
+            return future.result()
+
+    def getListing(self, dirName):
+        return list(self.getResult(self.listings, dirName, self.listDirectory))
+
+    def getLines(self, fileName):
+        return self.getResult(self.fileLines, fileName, self.readSuiteFile)
+
+
 class DirectoryCache:
-    def __init__(self, dir):
+    def __init__(self, dir, snapshot=None):
         self.dir = dir
         self.contents = []
-        self.refresh()
+        self.refresh(snapshot)
 
-    def refresh(self):
+    def refresh(self, snapshot=None):
         try:
-            self.contents = os.listdir(self.dir)
-            self.contents.sort()
+            if snapshot:
+                self.contents = snapshot.getListing(self.dir)
+            else:
+                self.contents = os.listdir(self.dir)
+                self.contents.sort()
         except OSError:  # usually caused by people removing stuff externally
             self.contents = []
+        self.contentSet = set(self.contents)
+        self.stemIndex = None
+        self.splitNames = None
+
+    def getStemIndex(self):
+        # Files grouped by the part of their name before the first ".", split into parts.
+        # Only built when needed, many caches are made for a single lookup
+        if self.stemIndex is None:
+            stemIndex = OrderedDict()
+            for fileName in self.contents:
+                parts = fileName.split(".")
+                stemIndex.setdefault(parts[0], []).append((fileName, parts))
+            self.stemIndex = stemIndex
+        return self.stemIndex
+
+    def getSplitNames(self):
+        if self.splitNames is None:
+            self.splitNames = list(map(self.splitStem, self.contents))
+        return self.splitNames
 
     def hasStem(self, stem):
-        for fileName in self.contents:
-            if fileName.startswith(stem):
-                return True
-        return False
+        index = bisect_left(self.contents, stem)
+        return index < len(self.contents) and self.contents[index].startswith(stem)
 
     def exists(self, fileName):
-        return fileName in self.contents
+        return fileName in self.contentSet
 
     def pathName(self, fileName):
         return os.path.join(self.dir, fileName)
@@ -74,11 +245,15 @@ class DirectoryCache:
             newCache = DirectoryCache(os.path.join(self.dir, root))
             return newCache.findVersionSets(local, predicate)
 
+        # Same as matching findVersionSet against every file, but only looks at those with the right start
+        stemParts = stem.split(".")
+        stemLength = len(stemParts)
         versionSets = OrderedDict()
-        for fileName in self.contents:
-            versionSet = self.findVersionSet(fileName, stem)
-            if versionSet is not None and (predicate is None or predicate(versionSet)):
-                versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
+        for fileName, parts in self.getStemIndex().get(stemParts[0], []):
+            if parts[:stemLength] == stemParts:
+                versionSet = frozenset(parts[stemLength:])
+                if predicate is None or predicate(versionSet):
+                    versionSets.setdefault(versionSet, []).append(self.pathName(fileName))
         return versionSets
 
     def findStemsMatching(self, pattern):
@@ -86,8 +261,7 @@ class DirectoryCache:
 
     def findAllStems(self, predicate=None):
         stems = []
-        for file in self.contents:
-            stem, versionSet = self.splitStem(file)
+        for stem, versionSet in self.getSplitNames():
             if len(stem) > 0 and stem not in stems and (predicate is None or predicate(stem, versionSet)):
                 stems.append(stem)
         return stems
@@ -915,7 +1089,7 @@ class TestCase(Test):
         os.rename(newPath, os.path.join(os.path.dirname(newPath), "backup.aborted"))
         stateFile = self.getStateFile()
         if os.path.isfile(stateFile):
-            return plugins.getNewTestStateFromFile(open(stateFile))
+            return plugins.getNewTestStateFromFile(open(stateFile, "rb"))
 
     def backupPreviousTemporaryData(self, restoreLatest=False):
         writeDir = self.getDirectory(temporary=1)
@@ -959,7 +1133,7 @@ class TestCase(Test):
             newState = plugins.getNewTestStateFromFile(file)
             newState.updateAfterLoad(self.app, **updateArgs)
             return True, newState
-        except (UnpicklingError, ImportError, EOFError, AttributeError):
+        except (UnpicklingError, ImportError, EOFError, AttributeError, stateformat.StateFormatError):
             return False, plugins.Unrunnable(briefText="read error",
                                              freeText="Failed to read results file")
 
@@ -972,9 +1146,13 @@ class TestCase(Test):
             # Don't overwrite previous saved state
             return
 
+        try:
+            data = stateformat.dumps(self.state)
+        except stateformat.UnsupportedValue:
+            # Something in there that only pickle knows how to write
+            data = dumps(self.state, protocol=2)
         file = plugins.openForWrite(stateFile, "wb")
-        pickler = Pickler(file, protocol=2)
-        pickler.dump(self.state)
+        file.write(data)
         file.close()
 
     def isAcceptedBy(self, filter, *args):
@@ -994,18 +1172,19 @@ class TestSuiteFileHandler:
     def __init__(self):
         self.cache = {}
 
-    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None):
-        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod)
+    def readWithWarnings(self, fileName, ignoreCache=False, filterMethod=None, snapshot=None):
+        items, badTests = self.readFromFileOrCache(fileName, ignoreCache, filterMethod, snapshot)
         goodTests = self.getTestWithDescriptions(items)
         self.cache[fileName] = items
         return goodTests, badTests
 
-    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None):
+    def readFromFileOrCache(self, fileName, ignoreCache=False, filterMethod=None, snapshot=None):
         if not ignoreCache:
             cached = self.cache.get(fileName)
             if cached is not None:
                 return cached, OrderedDict()
-        return plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod))
+        lines = snapshot.getLines(fileName) if snapshot else None
+        return plugins.readListWithComments(fileName, plugins.Callable(self.getExclusionReasons, filterMethod), lines)
 
     def getTestWithDescriptions(self, tests):
         onlyTest = OrderedDict()
@@ -1169,7 +1348,8 @@ class TestSuite(Test):
             return testNames, OrderedDict()
         fileName = self.getContentFileName()
         if fileName:
-            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists)
+            return self.testSuiteFileHandler.readWithWarnings(fileName, ignoreCache, self.fileExists,
+                                                              self.app.getTestTreeReader())
         else:
             return OrderedDict(), OrderedDict()
 
@@ -1343,7 +1523,7 @@ class TestSuite(Test):
                 subTest.notify("Add", initial)
 
     def createTestCache(self, testName):
-        return DirectoryCache(os.path.join(self.getDirectory(), testName))
+        return DirectoryCache(os.path.join(self.getDirectory(), testName), self.app.getTestTreeReader())
 
     def getSubtestClass(self, cache):
         return TestSuite if cache.hasStem("testsuite." + self.app.name) else TestCase
@@ -1533,6 +1713,9 @@ class Application(object):
         self.inputOptions = inputOptions
         self.configDir = plugins.MultiEntryDictionary(importKey="import_config_file", importFileFinder=self.configPath)
         self.overrideConfigDir = {}
+        self.versionSetOrders = {}
+        self.versionSetOrderConfig = None, None
+        self.testTreePrefetcher = None
         self.setUpConfiguration(configEntries)
         self.checkSanity()
         self.writeDirectory, self.localWriteDirectory = self.getWriteDirectories()
@@ -1851,18 +2034,43 @@ class Application(object):
             for vset, files in list(currVersionSets.items()):
                 versionSets.setdefault(vset, []).extend(files)
 
-        if allVersions:
-            sortedVersionSets = sorted(list(versionSets.keys()), key=cmp_to_key(self.compareForDisplay))
-        else:
-            sortedVersionSets = sorted(list(versionSets.keys()), key=cmp_to_key(self.compareForPriority))
+        sortedVersionSets = self.sortVersionSets(tuple(versionSets.keys()), allVersions)
         allFiles = []
         for vset in sortedVersionSets:
             allFiles += versionSets[vset]
         self.diag.info("Files for stem " + stem + " found " + repr(allFiles))
         return allFiles
 
+    def sortVersionSets(self, versionSets, allVersions):
+        # Most directories have the same few combinations of versions, so only sort each combination once
+        # while the config they depend on stays the same
+        configDir, generation = self.versionSetOrderConfig
+        if configDir is not self.configDir or generation != self.configDir.generation:
+            self.versionSetOrders = {}
+            self.versionSetOrderConfig = self.configDir, self.configDir.generation
+        cacheKey = versionSets, allVersions
+        if cacheKey not in self.versionSetOrders:
+            compareMethod = self.compareForDisplay if allVersions else self.compareForPriority
+            self.versionSetOrders[cacheKey] = sorted(versionSets, key=cmp_to_key(compareMethod))
+        return self.versionSetOrders[cacheKey]
+
     def getRefVersionApplication(self, refVersion):
-        return Application(self.name, self.dircache, refVersion.split("."), self.inputOptions)
+        # Reading all the config files again is expensive, and this is called for every test in places.
+        # So share them between everything using the same options, which they are made from
+        if not hasattr(self.inputOptions, "refVersionApps"):
+            self.inputOptions.refVersionApps = {}
+        key = self.name, self.dircache.dir, refVersion
+        refApp = self.inputOptions.refVersionApps.get(key)
+        if refApp is None or refApp.configFileTimes != refApp.getConfigFileTimes():
+            refApp = Application(self.name, self.dircache, refVersion.split("."), self.inputOptions)
+            refApp.configFileTimes = refApp.getConfigFileTimes()
+            self.inputOptions.refVersionApps[key] = refApp
+        return refApp
+
+    def getConfigFileTimes(self):
+        # A new file in the directory would also mean different config
+        fileNames = [self.dircache.dir] + self.configDir.filesRead
+        return [plugins.modifiedTime(fileName) for fileName in fileNames]
 
     def getPreviousWriteDirInfo(self, previousTmpInfo=""):
         # previousTmpInfo can be either a directory, which should be returned if it exists,
@@ -1918,6 +2126,10 @@ class Application(object):
         self.setConfigDefault("definition_file_stems", {"default": [], "regenerate": [], "builtin": ["config", "environment", "testsuite"]},
                               "files to be shown as definition files by the static GUI")
         self.setConfigDefault("unsaveable_version", [], "Versions which should not have results saved for them")
+        self.setConfigDefault("test_tree_snapshot_file", "",
+                              "File to store directory listings and test suite files in, to speed up reading the tests next time")
+        self.setConfigDefault("test_discovery_threads", 0,
+                              "Number of threads to read the test directories with in advance when reading the tests (0 means don't)")
         self.setConfigDefault("version_priority", {"default": 99},
                               "Mapping of version names to a priority order in case of conflict.")
         self.setConfigDefault("extra_search_directory", {"default": []},
@@ -1974,6 +2186,31 @@ class Application(object):
         suite.setObservers(responders)
         return suite
 
+    def getTestTreeSnapshot(self):
+        fileName = self.getConfigValue("test_tree_snapshot_file")
+        if fileName:
+            return TestTreeSnapshot.forFile(os.path.expanduser(fileName))
+
+    def getTestTreeReader(self):
+        # Where tests should get their directory listings and test suite files from, if not directly
+        return self.testTreePrefetcher or self.getTestTreeSnapshot()
+
+    def startTestTreeRead(self):
+        threads = self.getConfigValue("test_discovery_threads")
+        if threads > 0:
+            self.testTreePrefetcher = TestTreePrefetcher(self.name, threads, self.getTestTreeSnapshot())
+            self.testTreePrefetcher.readDirectory(self.dircache.dir)
+
+    def finishTestTreeRead(self):
+        # Anything read after this should see the files as they are then
+        if self.testTreePrefetcher:
+            self.testTreePrefetcher.stop()
+            self.testTreePrefetcher = None
+        snapshot = self.getTestTreeSnapshot()
+        if snapshot:
+            snapshot.save()
+        self.configObject.finishTestTreeRead(self)
+
     def createInitialTestSuite(self, responders):
         suite = self.makeTestSuite(responders)
         # allow the configurations to decide whether to accept the application in the presence of
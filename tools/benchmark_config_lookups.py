@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+
+"""
+Times the composite config lookups made for every test and file, e.g. failure_severity and
+run_dependent_text, with and without the lookup cache in MultiEntryDictionary.
+Run from the top of the source tree: python tools/benchmark_config_lookups.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from texttestlib.plugins import MultiEntryDictionary
+
+
+def makeConfig():
+    config = MultiEntryDictionary()
+    config["failure_severity"] = dict(("stem" + str(i) + "*", i % 3 + 1) for i in range(200))
+    config["failure_severity"]["default"] = 2
+    config["run_dependent_text"] = dict(("file" + str(i) + "*", ["pattern" + str(i)]) for i in range(100))
+    config["run_dependent_text"]["default"] = ["Process ID"]
+    return config
+
+
+def runLookups(config, lookup):
+    for stem in ("output", "errors", "stem150", "file42"):
+        lookup(config, "failure_severity", stem)
+        lookup(config, "run_dependent_text", stem)
+
+
+def uncachedLookup(config, key, subKey):
+    return config._getCompositeUnexpanded(key, subKey, "default")
+
+
+def cachedLookup(config, key, subKey):
+    return config.getComposite(key, subKey)
+
+
+def main():
+    config = makeConfig()
+    repeats = 2000
+    lookupsMade = repeats * 8
+    for name, lookup in [("uncached", uncachedLookup), ("cached", cachedLookup)]:
+        seconds = min(timeit.repeat(lambda: runLookups(config, lookup), number=repeats, repeat=5))
+        print(name.ljust(10), int(lookupsMade / seconds), "lookups/sec")
+
+
+if __name__ == "__main__":
+    main()